@@ -0,0 +1,179 @@
+'''
+Asynchronous extractions of the Eurostat dissemination API.
+
+Large data queries are not answered with the data but with a SOAP envelope announcing
+a queued job. Its status is polled at `{base_uri}/1.0/async/status/{key}` until it is
+AVAILABLE, then the data is fetched from `{base_uri}/1.0/async/data/{key}`.
+
+A single poller thread serves all jobs of the process, so any number of downloads can
+wait for their jobs at the same time. Every job is polled with exponential backoff.
+'''
+from concurrent.futures import Future
+import heapq
+import itertools
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from fmegeneral.fmelog import get_configured_logger
+
+from . import sessions
+from .constants import LOG_NAME
+from .sdmx import local_name
+
+REQUEST_TIMEOUT = 60
+STATUS_SUBMITTED = 'SUBMITTED'
+STATUS_PROCESSING = 'PROCESSING'
+STATUS_AVAILABLE = 'AVAILABLE'
+STATUS_EXPIRED = 'EXPIRED'
+STATUS_UNKNOWN_REQUEST = 'UNKNOWN_REQUEST'
+
+def async_base_uri(data_url):
+    """
+    Base uri of the async endpoints for a data url: `{base_uri}/sdmx/2.1/data/...` -> `{base_uri}`
+    """
+    base_uri, separator, _ = data_url.partition('/sdmx/')
+    if not separator:
+        raise Exception(f'Not an SDMX data url: {data_url}')
+    return base_uri
+
+def status_url(base_uri, key):
+    return f'{base_uri}/1.0/async/status/{key}'
+
+def data_url(base_uri, key):
+    return f'{base_uri}/1.0/async/data/{key}'
+
+def _find_text(text, names):
+    """
+    Text of the first element with one of the local `names`, None if `text` is not such an xml document
+    """
+    try:
+        root = ET.fromstring(text)
+    except ET.ParseError:
+        return None
+    for elem in root.iter():
+        if local_name(elem.tag) in names and elem.text and elem.text.strip():
+            return elem.text.strip()
+    return None
+
+def parse_queued(text):
+    """
+    Key of the job announced by a `queued` response to a data query, None for any other response
+    """
+    if 'queued' not in text:
+        return None
+    return _find_text(text, ('key', 'id'))
+
+def parse_status(text):
+    """
+    Status of a job from the response of the status endpoint
+    """
+    try:
+        root = ET.fromstring(text)
+    except ET.ParseError:
+        return None
+    for elem in root.iter():
+        # The status element contains the key and a nested status element with the value
+        if 'status' == local_name(elem.tag) and not len(elem) and elem.text and elem.text.strip():
+            return elem.text.strip()
+    return None
+
+class _Job:
+    __slots__ = ('base_uri', 'key', 'future', 'deadline', 'interval')
+    def __init__(self, base_uri, key, future, deadline, interval):
+        self.base_uri = base_uri
+        self.key = key
+        self.future = future
+        self.deadline = deadline
+        self.interval = interval
+
+class AsyncJobManager:
+    def __init__(self, poll_interval=2, max_poll_interval=60, timeout=4 * 60 * 60):
+        """
+        :param float poll_interval: Seconds before a job is polled for the first time.
+        :param float max_poll_interval: The interval doubles after every poll up to this limit.
+        :param float timeout: Seconds after which a job that is not available is given up.
+        """
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._timeout = timeout
+        self._condition = threading.Condition()
+        self._queue = []                 # (next poll time, sequence, job)
+        self._sequence = itertools.count()
+        self._thread = None
+
+    def submit(self, base_uri, key):
+        """
+        Start polling the job `key`
+
+        :returns: Future of the url to fetch the data from once the job is available.
+        :rtype: concurrent.futures.Future
+        """
+        get_configured_logger(LOG_NAME).info('Waiting for asynchronous job %s', key)
+        future = Future()
+        now = time.monotonic()
+        job = _Job(base_uri, key, future, now + self._timeout, self._poll_interval)
+        with self._condition:
+            heapq.heappush(self._queue, (now + job.interval, next(self._sequence), job))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='eurostat-async-jobs', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def wait(self, base_uri, key):
+        """
+        Block until the job `key` is available and return the url of its data
+        """
+        return self.submit(base_uri, key).result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._queue:
+                        self._condition.wait()
+                        continue
+                    due, _, job = self._queue[0]
+                    delay = due - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._queue)
+                        break
+                    self._condition.wait(delay)
+            if self._poll(job):
+                continue
+            job.interval = min(job.interval * 2, self._max_poll_interval)
+            with self._condition:
+                heapq.heappush(self._queue, (time.monotonic() + job.interval, next(self._sequence), job))
+
+    def _poll(self, job):
+        """
+        Poll a single job, resolving its future if it is finished
+
+        :returns: True if the job is finished, successfully or not.
+        """
+        log = get_configured_logger(LOG_NAME)
+        if job.future.cancelled():
+            return True
+        try:
+            r = sessions.get(status_url(job.base_uri, job.key), timeout=REQUEST_TIMEOUT)
+            r.raise_for_status()
+            status = parse_status(r.text)
+        except Exception as e:
+            # A failing status request is retried at the next poll
+            log.warn('Polling asynchronous job %s failed: %s', job.key, e)
+            status = None
+        log.info('Asynchronous job %s: %s', job.key, status)
+        if STATUS_AVAILABLE == status:
+            job.future.set_result(data_url(job.base_uri, job.key))
+            return True
+        if status in (STATUS_EXPIRED, STATUS_UNKNOWN_REQUEST):
+            job.future.set_exception(Exception(f'Asynchronous job {job.key} is {status}'))
+            return True
+        if time.monotonic() > job.deadline:
+            job.future.set_exception(Exception(f'Asynchronous job {job.key} not available after {self._timeout} s'))
+            return True
+        return False
+
+# Shared by all downloads of the process
+JOBS = AsyncJobManager()
@@ -0,0 +1,311 @@
+'''
+Local on-disk cache for structures that are expensive to download and parse.
+
+Entries are pickled into the Local Cache Folder of the named connection and
+are valid until they are older than the Expiry Time of the connection.
+Files are written under a temporary name and moved into place with `os.replace`,
+so concurrently running engines never see a partially written entry.
+
+Downloaded data files are cached in the `data` subfolder under the sha256 of the
+query that produced them. A hit is hard-linked into the target folder, and only
+copied if the target is on another volume. Expired data files are kept for a while
+to be updated with the changed observations only, then removed by `purge_files`.
+'''
+from collections import defaultdict
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from fmegeneral.fmelog import get_configured_logger
+
+from . import locks
+from .constants import LOG_NAME, DEFAULT_CACHE_TIMEOUT
+
+CACHE_FILE_EXT = '.pickle'
+DATA_FOLDER = 'data'
+# Expired data files are kept this many seconds for incremental updates before they are removed
+DATA_RETENTION = 7 * 24 * 60 * 60
+# Seconds an `updatedAfter` checkpoint is moved back to cover the uncertainty of the server clock
+UPDATED_AFTER_MARGIN = 5 * 60
+# The data folder is scanned for files to remove at most once per this many seconds
+PURGE_INTERVAL = 60 * 60
+# Content address at the start of the names of the files of a data cache entry, temporary files start with a dot
+DATA_FILENAME_PATTERN = re.compile(r'^\.?([0-9a-f]{64})\.')
+
+_purge_lock = threading.Lock()
+_last_purges = dict()       # time of the last purge by cache folder
+
+def parse_timeout(value, default=DEFAULT_CACHE_TIMEOUT):
+    """
+    Interpret the CACHE_TIMEOUT value of a named connection as seconds
+    """
+    if value is None or not str(value).strip():
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        get_configured_logger(LOG_NAME).warn('Invalid cache timeout `%s`, using %s seconds', value, default)
+        return default
+
+def cache_filepath(cache_folder, name):
+    return os.path.join(cache_folder, f'{name}{CACHE_FILE_EXT}')
+
+def load_entry(cache_folder, name):
+    """
+    Return the payload stored under `name` and its age in seconds, expired or not
+
+    :returns: Tuple (payload, age), or (None, None) if there is no readable entry.
+    """
+    log = get_configured_logger(LOG_NAME)
+    filepath = cache_filepath(cache_folder, name)
+    try:
+        age = time.time() - os.path.getmtime(filepath)
+    except OSError:
+        return None, None
+    try:
+        with open(filepath, 'rb') as f:
+            payload = pickle.load(f)
+    except Exception as e:
+        log.warn('Ignoring unreadable cache entry `%s`: %s', filepath, e)
+        return None, None
+    return payload, age
+
+def touch(cache_folder, name):
+    """
+    Restart the expiry time of an entry that has been revalidated
+    """
+    filepath = cache_filepath(cache_folder, name)
+    try:
+        os.utime(filepath)
+    except OSError as e:
+        get_configured_logger(LOG_NAME).warn('Unable to touch cache entry `%s`: %s', filepath, e)
+
+def save(cache_folder, name, payload):
+    """
+    Atomically store `payload` under `name`
+    """
+    log = get_configured_logger(LOG_NAME)
+    filepath = cache_filepath(cache_folder, name)
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        fd, tmp_filepath = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=cache_folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filepath, filepath)
+        except BaseException:
+            os.remove(tmp_filepath)
+            raise
+    except Exception as e:
+        # A failing cache must never break browsing or reading
+        log.warn('Unable to write cache entry `%s`: %s', filepath, e)
+        return
+    log.info('Cache entry `%s` written', filepath)
+
+def data_key(agency_id, dataflow_id, params, key_filter=None):
+    """
+    Content address of a data query
+
+    :param dict params: Query parameters of the data request (format, compression, periods, ...).
+    :param dict key_filter: Dimension values the series keys are restricted to, by dimension id.
+    """
+    query = {
+          'agency': agency_id
+        , 'dataflow': dataflow_id
+        , 'params': {k: str(v) for k,v in params.items()}
+        , 'key': {k.upper(): sorted(v) for k,v in (key_filter or dict()).items()}
+    }
+    data = json.dumps(query, sort_keys=True, separators=(',', ':')).encode('utf8')
+    return hashlib.sha256(data).hexdigest()
+
+def data_filepath(cache_folder, key, ext='.csv'):
+    return os.path.join(cache_folder, DATA_FOLDER, key[:2], f'{key}{ext}')
+
+def partial_filepath(cache_folder, key, ext='.csv'):
+    """
+    Location to download the data file with content address `key` to before it is stored
+
+    The name is the same for every attempt, so an interrupted download can be resumed.
+    """
+    filepath = data_filepath(cache_folder, key, f'.partial{ext}')
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    return filepath
+
+def link_file(src_filepath, dst_filepath):
+    """
+    Hard-link `src_filepath` as `dst_filepath`, copy it if linking is not possible
+    """
+    try:
+        os.link(src_filepath, dst_filepath)
+    except OSError:
+        # Never leave a partial copy under the final name
+        shutil.copyfile(src_filepath, f'{dst_filepath}.tmp')
+        os.replace(f'{dst_filepath}.tmp', dst_filepath)
+
+def file_entry(cache_folder, key, ext='.csv'):
+    """
+    Path and age in seconds of the cached data file with content address `key`, expired or not
+
+    :returns: Tuple (filepath, age), or (None, None) if there is no such file.
+    """
+    filepath = data_filepath(cache_folder, key, ext)
+    try:
+        age = time.time() - os.path.getmtime(filepath)
+    except OSError:
+        return None, None
+    return filepath, age
+
+def lookup_file(cache_folder, key, timeout=DEFAULT_CACHE_TIMEOUT, ext='.csv'):
+    """
+    Path of the cached data file with content address `key`, or None if it is missing or expired
+    """
+    log = get_configured_logger(LOG_NAME)
+    filepath, age = file_entry(cache_folder, key, ext)
+    if filepath is None:
+        return None
+    if age > timeout:
+        log.info('Cached data file `%s` expired (%.0f s old)', filepath, age)
+        return None
+    log.info('Using cached data file `%s` (%.0f s old)', filepath, age)
+    return filepath
+
+def info_filepath(cache_folder, key, ext='.csv'):
+    """
+    Metadata file of a cached data file, `.csv` and `.csv.gz` files of a query are separate entries
+    """
+    return data_filepath(cache_folder, key, f'{ext}.json')
+
+def load_file_info(cache_folder, key, ext='.csv'):
+    """
+    Metadata stored next to a cached data file by `store_file`, an empty dict if there is none
+    """
+    try:
+        with open(info_filepath(cache_folder, key, ext), encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def save_file_info(cache_folder, key, info, ext='.csv'):
+    filepath = info_filepath(cache_folder, key, ext)
+    fd, tmp_filepath = tempfile.mkstemp(prefix=f'.{key}.', suffix='.tmp', dir=os.path.dirname(filepath))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            json.dump(info, f)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+
+def touch_file(cache_folder, key, info=None, ext='.csv'):
+    """
+    Restart the expiry time of a cached data file that is still up to date
+    """
+    try:
+        os.utime(data_filepath(cache_folder, key, ext))
+        if info is not None:
+            save_file_info(cache_folder, key, info, ext)
+    except OSError as e:
+        get_configured_logger(LOG_NAME).warn('Unable to touch cached data file %s: %s', key, e)
+
+def utc_timestamp(seconds=None):
+    """
+    ISO 8601 timestamp as used by the `updatedAfter` query parameter
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(seconds))
+
+def update_checkpoint(started, clock_offset=0.0):
+    """
+    `updatedAfter` value for the next update of data whose download started at local time `started`
+
+    :param float clock_offset: Seconds the clock of the server is ahead of the local clock.
+        The timestamp is on the clock of the server, less UPDATED_AFTER_MARGIN: changes
+        requested twice are merged again without harm, changes missed are lost for good.
+    """
+    return utc_timestamp(started + clock_offset - UPDATED_AFTER_MARGIN)
+
+def store_file(cache_folder, key, src_filepath, info=None, ext='.csv'):
+    """
+    Atomically add the downloaded file `src_filepath` to the cache under content address `key`
+
+    :param dict info: Metadata to store next to the file, e.g. the time of the download.
+    """
+    log = get_configured_logger(LOG_NAME)
+    filepath = data_filepath(cache_folder, key, ext)
+    folder = os.path.dirname(filepath)
+    try:
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_filepath = tempfile.mkstemp(prefix=f'.{key}.', suffix='.tmp', dir=folder)
+        os.close(fd)
+        try:
+            os.remove(tmp_filepath)
+            link_file(src_filepath, tmp_filepath)
+            os.replace(tmp_filepath, filepath)
+            if info is not None:
+                save_file_info(cache_folder, key, info, ext)
+        except BaseException:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+    except Exception as e:
+        log.warn('Unable to cache data file `%s`: %s', filepath, e)
+        return
+    log.info('Data file cached as `%s`', filepath)
+
+def purge_files(cache_folder, timeout=DEFAULT_CACHE_TIMEOUT, retention=DATA_RETENTION):
+    """
+    Remove the data cache entries that have not been downloaded, updated or used
+    for `timeout` + `retention` seconds: data file, metadata, partial downloads and lock file
+
+    Entries locked by a running download, in this or another process, are kept.
+    The data folder is scanned at most once per PURGE_INTERVAL.
+    """
+    log = get_configured_logger(LOG_NAME)
+    with _purge_lock:
+        now = time.time()
+        if now - _last_purges.get(cache_folder, 0) < PURGE_INTERVAL:
+            return
+        _last_purges[cache_folder] = now
+    data_folder = os.path.join(cache_folder, DATA_FOLDER)
+    limit = now - timeout - retention
+    removed = 0
+    try:
+        subfolders = os.listdir(data_folder)
+    except OSError:
+        return
+    for subfolder in subfolders:
+        folder = os.path.join(data_folder, subfolder)
+        try:
+            filenames = os.listdir(folder)
+        except OSError:
+            continue
+        entries = defaultdict(list)     # file paths by content address
+        for filename in filenames:
+            m = DATA_FILENAME_PATTERN.match(filename)
+            if m:
+                entries[m.group(1)].append(os.path.join(folder, filename))
+        for key, filepaths in entries.items():
+            try:
+                if max(os.path.getmtime(filepath) for filepath in filepaths) > limit:
+                    continue
+            except OSError:
+                continue
+            lock_filepath = data_filepath(cache_folder, key, '.lock')
+            # A download waiting for the removed lock file repeats the download at worst
+            with locks.try_file_lock(lock_filepath, remove=True) as locked:
+                if not locked:
+                    continue
+                for filepath in filepaths:
+                    if filepath != lock_filepath:
+                        try:
+                            os.remove(filepath)
+                        except OSError as e:
+                            log.warn('Unable to remove expired cache file `%s`: %s', filepath, e)
+            removed += 1
+    if removed:
+        log.info('Removed %s expired data files from `%s`', removed, data_folder)
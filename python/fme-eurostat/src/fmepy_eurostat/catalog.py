@@ -1,47 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict
 from dataclasses import dataclass
-import gzip
 import re
+from sys import intern
+import threading
+import time
 from typing import List
+from urllib.parse import parse_qs, urlparse
+from xml.etree.ElementTree import ParseError
 from fmeobjects import FMESession, FMEFeature, FMEFactoryPipeline
 from fmegeneral.fmelog import get_configured_logger
 from fmegeneral.webservices import FMENamedConnectionManager
 
 from .constants import (LOG_NAME, Agency, PACKAGE_KEYWORD)
+from . import cache, datastructure, download, locks, sessions
+from .registry import CatalogRegistry
+from .search import SearchIndex
+from .sdmx import (
+    CategorySchemeRecord,
+    CategoryRecord,
+    CategorisationRecord,
+    DataflowRecord,
+    NotModified,
+    open_structure,
+    parse_catalog_structures
+)
+from ._vendor.webserviceconnector.util_pool_worker import map_to_new_pool, PoolWorkerResult
 from ._vendor.webserviceconnector.fmewebfs import (
     ContainerContentResponse,
     ContainerItem,
+    ContinuationInfo,
     IFMEWebFilesystem
 )
 import os.path
 XFMAP = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'xfmap', 'data_discovery.xmp')
+FOLDER_NAME_INVALID_CHARS = re.compile(r'[\\/:*?"<>|]+')
+# Increment whenever the structure of the cached catalog changes
+CATALOG_CACHE_VERSION = 5
 
+# Catalog nodes use __slots__, a long-running engine keeps several agencies worth of them in memory
 @dataclass
 class Item:
+    __slots__ = ('name', 'id')
     name: str
     id: str
 
 @dataclass
 class Container(Item):
+    __slots__ = ('children',)
     children: List[any]
 
 @dataclass
 class CategoryScheme(Container):
+    __slots__ = ('xml_id',)
     xml_id: str
 
 @dataclass
 class Category(Container):
+    __slots__ = ('urn', 'xml_id', 'xml_parent_id')
     urn: str
     xml_id: str
     xml_parent_id: str
 
-@dataclass
-class Categorisation:
-    category_urn: str
-    dataflow_key: str
+class Catalog:
+    """
+    Graph of category schemes, categories and dataflow items
 
-def read_catalog(datasets, item_key_func=lambda dataflow_id: dataflow_id):
+    Nodes are linked as soon as their records are added. Records may arrive in any order,
+    links to nodes that are not known yet are kept in pending tables until the node is added.
     """
-    Read categorization xml files into tree structure
+    def __init__(self):
+        # Set once all category schemes are known, respectively once the catalog is complete
+        self.roots_ready = threading.Event()
+        self.ready = threading.Event()
+        self.reset()
+
+    def reset(self):
+        """
+        Remove all records to read the catalog again
+
+        The events are kept, threads may already be waiting on them.
+        """
+        self.tree = dict()                  # containers by id
+        self.items = dict()                 # dataflow items by key
+        self.containers_by_urn = dict()
+        self.containers_by_xml_id = dict()
+        self.roots = []                     # category schemes in the order they were added
+        self.validators = dict()            # ETag/Last-Modified of the structure messages by url
+        self._search_index = None
+        self._pending_children = defaultdict(list)         # xml_parent_id -> categories
+        self._pending_items = defaultdict(list)            # dataflow key -> categories
+        self._pending_categorisations = defaultdict(list)  # category urn -> dataflow keys
+        self.roots_ready.clear()
+        self.ready.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['_pending_children', '_pending_items', '_pending_categorisations', 'roots_ready', 'ready', '_search_index']:
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._search_index = None
+        self._pending_children = defaultdict(list)
+        self._pending_items = defaultdict(list)
+        self._pending_categorisations = defaultdict(list)
+        self.roots_ready = threading.Event()
+        self.roots_ready.set()
+        self.ready = threading.Event()
+        self.ready.set()
+
+    def add(self, record, item_key_func):
+        if isinstance(record, CategoryRecord):
+            self.add_category(record)
+        elif isinstance(record, CategorySchemeRecord):
+            self.add_category_scheme(record)
+        elif isinstance(record, CategorisationRecord):
+            self.add_categorisation(record, intern(item_key_func(record.dataflow_id)))
+        elif isinstance(record, DataflowRecord):
+            self.add_dataflow(record, intern(item_key_func(record.id)))
+
+    def add_category_scheme(self, record):
+        id, xml_id = intern(record.id), intern(record.xml_id)
+        children = self._pending_children.pop(xml_id, [])
+        category_scheme = CategoryScheme(record.name, id, children, xml_id)
+        self.containers_by_xml_id[xml_id] = category_scheme
+        self.tree[id] = category_scheme
+        self.roots.append(category_scheme)
+
+    def add_category(self, record):
+        # Interned, so the node and the indexes share a single copy of every identifier
+        id, urn = intern(record.id), intern(record.urn)
+        xml_id, xml_parent_id = intern(record.xml_id), intern(record.xml_parent_id)
+        children = self._pending_children.pop(xml_id, [])
+        category = Category(record.name, id, children, urn, xml_id, xml_parent_id)
+        self.containers_by_xml_id[xml_id] = category
+        self.containers_by_urn[urn] = category
+        self.tree[id] = category
+        parent = self.containers_by_xml_id.get(xml_parent_id)
+        if parent is None:
+            self._pending_children[xml_parent_id].append(category)
+        else:
+            parent.children.append(category)
+        for dataflow_key in self._pending_categorisations.pop(urn, []):
+            self._link_item(category, dataflow_key)
+
+    def add_categorisation(self, record, dataflow_key):
+        category = self.containers_by_urn.get(record.category_urn)
+        if category is None:
+            self._pending_categorisations[intern(record.category_urn)].append(dataflow_key)
+        else:
+            self._link_item(category, dataflow_key)
+
+    def add_dataflow(self, record, dataflow_key):
+        '''
+        These are the leaves. The ID that we communicate with FME here must conform to some rules
+        in order for FME to recognize it later on
+        '''
+        name = '{} [{}]'.format(record.name, record.id)
+        item = Item(name, dataflow_key)
+        self.items[dataflow_key] = item
+        for category in self._pending_items.pop(dataflow_key, []):
+            category.children.append(item)
+
+    def _link_item(self, category, dataflow_key):
+        item = self.items.get(dataflow_key)
+        if item is None:
+            self._pending_items[dataflow_key].append(category)
+        else:
+            category.children.append(item)
+
+    def search(self, query):
+        """
+        Dataflow items matching all terms of `query`, best matches first
+
+        The index is built on the first search after the catalog has been loaded.
+        """
+        if self._search_index is None:
+            self._search_index = SearchIndex(self.items.values())
+        return self._search_index.search(query)
+
+    def finish(self):
+        """
+        Report unresolved links and mark the catalog as complete
+        """
+        log = get_configured_logger(LOG_NAME)
+        orphans = [
+            category
+            for categories in self._pending_children.values()
+            for category in categories
+        ]
+        for category in orphans:
+            log.warn('Orphan detected: %s %s', category.id, category.xml_parent_id)
+        if orphans:
+            log.warn('Orphans detected: %s', len(orphans))
+        self._pending_children.clear()
+        self._pending_items.clear()
+        self._pending_categorisations.clear()
+        self.roots_ready.set()
+        self.ready.set()
+
+def iter_xfmap_records(datasets):
+    """
+    Read the structure messages with the FME XML reader and xfmap/data_discovery.xmp
+
+    This is the original implementation, kept as fallback for the native parser.
+    Yields the same records as `sdmx.parse_catalog_structures`.
     """
     log = get_configured_logger(LOG_NAME)
     fme_session = FMESession()
@@ -82,13 +247,7 @@ def read_catalog(datasets, item_key_func=lambda dataflow_id: dataflow_id):
         log.info('Reading dataset `%s`', dataset)
         pipeline.processFeature(feature)
     pipeline.allDone()
-    tree = dict()
-    items = dict()
-    containers_by_xml_id = dict()
-    containers_by_urn = dict()
-    categorizations = []
     log.info('Emptying factory pipeline')
-    # Iterating records twice because we need to resolve relations...
     while True:
         feature = pipeline.getOutputFeature()
         if feature is None:
@@ -100,63 +259,143 @@ def read_catalog(datasets, item_key_func=lambda dataflow_id: dataflow_id):
         if 'Category' == fme_feature_type:
             if 'T' == feature.getAttribute('CategoryScheme.dissemination_perspective_id'):
                 continue
-            id = feature.getAttribute('Category.id')
-            urn = feature.getAttribute('Category.urn')
-            xml_id = feature.getAttribute('xml_id')
-            xml_parent_id = feature.getAttribute('xml_parent_id')
-            name = feature.getAttribute('Category.name')
-            children = []
-            category = Category(name, id, children, urn, xml_id, xml_parent_id)
-            containers_by_xml_id[xml_id] = category
-            containers_by_urn[urn] = category
-            tree[id] = category
+            yield CategoryRecord(
+                  feature.getAttribute('Category.id')
+                , feature.getAttribute('Category.name')
+                , feature.getAttribute('Category.urn')
+                , feature.getAttribute('xml_id')
+                , feature.getAttribute('xml_parent_id')
+            )
         elif 'CategoryScheme' == fme_feature_type:
             if 'T' == feature.getAttribute('CategoryScheme.dissemination_perspective_id'):
                 continue
-            id = feature.getAttribute('CategoryScheme.id')
-            xml_id = feature.getAttribute('xml_id')
-            name = feature.getAttribute('CategoryScheme.name')
-            children = []
-            category_scheme = CategoryScheme(name, id, children, xml_id)
-            containers_by_xml_id[xml_id] = category_scheme
-            tree[id] = category_scheme
+            yield CategorySchemeRecord(
+                  feature.getAttribute('CategoryScheme.id')
+                , feature.getAttribute('CategoryScheme.name')
+                , feature.getAttribute('xml_id')
+            )
         elif 'Categorisation' == fme_feature_type:
             if 'T' == feature.getAttribute('Categorisation.dissemination_perspective_id'):
                 continue
-            category_urn = feature.getAttribute('Categorisation.Target.urn')
-            dataflow_id = feature.getAttribute('Categorisation.Source.id')
-            dataflow_key = item_key_func(dataflow_id)
-            categorization = Categorisation(category_urn, dataflow_key)
-            categorizations.append(categorization)
-            
+            yield CategorisationRecord(
+                  feature.getAttribute('Categorisation.Target.urn')
+                , feature.getAttribute('Categorisation.Source.id')
+            )
         elif 'Dataflow' == fme_feature_type:
-            '''
-            These are the leaves. The ID that we communicate with FME here must conform to some rules
-            in order for FME to recognize it later on
-            '''
-            dataflow_id = feature.getAttribute('Dataflow.id')
-            id = item_key_func(dataflow_id)
-            name = '{} [{}]'.format(feature.getAttribute('Dataflow.name'), dataflow_id)
-            item = Item(name, id)
-            items[id] = item
-
-    orphans = []
-    for k,v in tree.items():
-        if Category == type(v):
-            parent = containers_by_xml_id.get(v.xml_parent_id)
-            if parent is None:
-                orphans.append(v)
-                log.warn('Orphan detected: %s %s', k, v.xml_parent_id)
-                continue
-            parent.children.append(v)
-    if orphans:
-        log.warn('Orphans detected: %s', len(orphans))
-    for categorization in categorizations:
-        container = containers_by_urn.get(categorization.category_urn)
-        item = items.get(categorization.dataflow_key)
-        if Category == type(container) and Item == type(item):
-            container.children.append(item)
-    return tree, items
+            yield DataflowRecord(
+                  feature.getAttribute('Dataflow.id')
+                , feature.getAttribute('Dataflow.name')
+            )
+
+def read_structure_records(dataset, validators=None):
+    """
+    Stream a single structure message through the native SDMX-ML parser
+
+    :param dict validators: Validators of a cached copy, makes the request conditional.
+    :returns: Tuple of the dataset, its records and the validators of the response.
+        The records are None if the document did not change since `validators`.
+    """
+    log = get_configured_logger(LOG_NAME)
+    log.info('Reading dataset `%s`', dataset)
+    try:
+        with open_structure(dataset, validators) as (fin, response_validators):
+            records = list(parse_catalog_structures(fin))
+    except NotModified:
+        log.info('Dataset `%s` not modified', dataset)
+        return dataset, None, validators
+    log.info('Dataset `%s` parsed, %s records', dataset, len(records))
+    return dataset, records, response_validators
+
+def iter_native_records(datasets, validators=None):
+    """
+    Fetch and parse the structure messages concurrently
+
+    Every document is parsed by its own worker while it is being downloaded,
+    a tuple (dataset, records, validators) is yielded as soon as the document is complete.
+
+    :param dict validators: Validators of cached copies by dataset. The requests are conditional then
+        and NotModified is raised if none of the documents changed. Unchanged documents are
+        fetched again, unconditionally, if any of the others did change.
+    """
+    validators = validators or dict()
+    with ThreadPoolExecutor(max_workers=max(1, len(datasets))) as executor:
+        futures = [
+            executor.submit(read_structure_records, dataset, validators.get(dataset))
+            for dataset in datasets
+        ]
+        not_modified = []
+        for future in as_completed(futures):
+            dataset, records, response_validators = future.result()
+            if records is None:
+                not_modified.append(dataset)
+            else:
+                yield dataset, records, response_validators
+        if not_modified and len(not_modified) == len(datasets):
+            raise NotModified(*datasets)
+        futures = [executor.submit(read_structure_records, dataset) for dataset in not_modified]
+        for future in as_completed(futures):
+            yield future.result()
+
+def read_catalog(datasets, item_key_func=lambda dataflow_id: dataflow_id, use_xfmap=False, catalog=None, validators=None):
+    """
+    Read categorization xml files into tree structure
+
+    :param list datasets: Urls (or local paths) of the category schemes, categorisations and dataflows.
+    :param item_key_func: Makes the key of a dataflow item from its id.
+    :param bool use_xfmap: Read the documents with the FME XML reader instead of the native parser.
+    :param Catalog catalog: Catalog to populate, lets other threads use it while it is being read.
+    :param dict validators: `Catalog.validators` of a cached catalog, NotModified is raised
+        if none of the documents changed since.
+    :rtype: Catalog
+    """
+    log = get_configured_logger(LOG_NAME)
+    if catalog is None:
+        catalog = Catalog()
+    if use_xfmap:
+        documents = [(None, iter_xfmap_records(datasets), None)]
+    else:
+        documents = iter_native_records(datasets, validators)
+    try:
+        for dataset, records, response_validators in documents:
+            for record in records:
+                catalog.add(record, item_key_func)
+            if response_validators:
+                catalog.validators[dataset] = response_validators
+            if catalog.roots:
+                # All category schemes are defined in the same document
+                catalog.roots_ready.set()
+    except ParseError as e:
+        if use_xfmap:
+            raise
+        log.warn('Native parsing of the catalog failed (%s), falling back to the FME XML reader', e)
+        catalog.reset()
+        return read_catalog(datasets, item_key_func, use_xfmap=True, catalog=catalog)
+    catalog.finish()
+    return catalog
+
+CATALOGS = CatalogRegistry(Catalog)
+
+def dataflow_id_from_key(key):
+    """
+    Dataflow id of an `fme://` key made by `EurostatFilesystem.make_dataflow_url_key`, bare ids are returned as is
+    """
+    if not key.startswith('fme://'):
+        return key
+    dataflow_id, *_ = parse_qs(urlparse(key).query).get('id', [key])
+    return dataflow_id
+
+def iter_folder_items(container, folder, include_sub_folders=True):
+    """
+    Dataflow items below `container` with the local folder they belong in, subfolders are named after the categories
+
+    :returns: Generator of (folder, Item) tuples, depth first in catalog order.
+    """
+    for child in container.children:
+        if isinstance(child, Container):
+            if include_sub_folders:
+                yield from iter_folder_items(child, os.path.join(folder, FOLDER_NAME_INVALID_CHARS.sub('_', child.name or child.id).strip()), True)
+        else:
+            yield folder, child
 
 def makeInstance(args):
     """
@@ -173,7 +412,7 @@ class EurostatFilesystem(IFMEWebFilesystem):
         self._log = get_configured_logger(self.keyword)
         sorted_params = {
             k: params[k] 
-            for k in sorted(params.keys() - {'fme_connection_group','constraints_group','quick_ref_group','quick_ref'})
+            for k in sorted(params.keys() - {'fme_connection_group','constraints_group','quick_ref_group','quick_ref','parallel_group','keep_compressed'})
             if params[k] is not None and len(params[k])
         }
         import zlib
@@ -187,6 +426,8 @@ class EurostatFilesystem(IFMEWebFilesystem):
             for k,v in sorted_params.items()
         )
         agency_id = 'ESTAT'
+        self._cache_folder = None
+        self._cache_timeout = cache.parse_timeout(None)
         if 'connection' in params:
             nc_name = params['connection']
             nc = FMENamedConnectionManager().getNamedConnection(nc_name)
@@ -194,19 +435,84 @@ class EurostatFilesystem(IFMEWebFilesystem):
                 self._log.info('Using settings from named connection %s', nc_name)
                 nc_params = nc.getKeyValues()
                 agency_id = nc_params['AGENCY']
+                self._cache_folder = nc_params.get('CACHE_FOLDER') or None
+                self._cache_timeout = cache.parse_timeout(nc_params.get('CACHE_TIMEOUT'))
+                sessions.configure_connection(Agency[agency_id], nc_params)
             else:
                 self._log.warn('Named Connection %s not found', nc_name)
         elif 'agency' in params:
             agency_id = params['agency']
 
         self._agency = Agency[agency_id]
-        self._tree = None
-        self._items = None
+        # The catalog only knows bare dataflow ids, it is the same for all url parameters
+        self._catalog_key = self._agency.name
+        self._catalog = None
+        self._last_search = None   # (query, items), keeps paging through search results cheap
+        # The CSV reader inflates .csv.gz itself, downloads can then stay compressed on disk
+        self._file_ext = '.csv.gz' if 'YES' == params.get('keep_compressed') else '.csv'
         self._log.info('EurostatFilesystem initialized with params %s', str(params))
 
     def make_dataflow_url_key(self, dataflow_id):
         # fme://eea.fme-eurostat.fme-eurostat/FOR_ECO_CP?id=FOR_ECO_CP&module=fmepy_eurostat.catalog&webservice=eea.eurostat.Eurostat&asdf=bsdf
-        return f'fme://eea.fme-eurostat.fme-eurostat/{dataflow_id}{self._params_hash}.csv?id={dataflow_id}&module=fmepy_eurostat.catalog&webservice=eea.eurostat.Eurostat&{self._url_params}'
+        return f'fme://eea.fme-eurostat.fme-eurostat/{dataflow_id}{self._params_hash}{self._file_ext}?id={dataflow_id}&module=fmepy_eurostat.catalog&webservice=eea.eurostat.Eurostat&{self._url_params}'
+
+    def _get_catalog(self, roots_only=False):
+        """
+        Catalog of the agency, shared with all other instances through the catalog registry
+
+        :param bool roots_only: Accept a catalog that is still being read once its roots are known.
+        :rtype: Catalog
+        """
+        if self._catalog is not None:
+            return self._catalog
+        catalog = CATALOGS.get(
+              self._catalog_key
+            , self._read_catalog
+            , max_age=self._cache_timeout
+            , roots_only=roots_only
+        )
+        if catalog.ready.is_set():
+            self._catalog = catalog
+        return catalog
+
+    def _read_catalog(self, catalog):
+        """
+        Populate `catalog`, or return the catalog from the local cache folder if possible
+
+        An expired cached catalog is revalidated with conditional requests
+        and reused if none of the structure messages changed.
+        """
+        cache_name = f'catalog_{self._catalog_key}'
+        stale_catalog = None
+        if self._cache_folder:
+            payload, age = cache.load_entry(self._cache_folder, cache_name)
+            if payload and CATALOG_CACHE_VERSION == payload.get('version'):
+                if age <= self._cache_timeout:
+                    self._log.info('Using cached catalog of %s (%.0f s old)', self._catalog_key, age)
+                    return payload['catalog']
+                stale_catalog = payload['catalog']
+        datasets = [
+              self._agency.category_schemes_url
+            , self._agency.categorisations_url
+            , self._agency.dataflows_url
+        ]
+        try:
+            read_catalog(
+                  datasets
+                , catalog=catalog
+                , validators=stale_catalog.validators if stale_catalog else None
+            )
+        except NotModified:
+            self._log.info('Catalog of %s not modified, reusing cached catalog', self._catalog_key)
+            cache.touch(self._cache_folder, cache_name)
+            return stale_catalog
+        sessions.log_stats()
+        if self._cache_folder:
+            cache.save(self._cache_folder, cache_name, {
+                  'version': CATALOG_CACHE_VERSION
+                , 'catalog': catalog
+            })
+        return catalog
 
     @property
     def _driver(self):
@@ -251,48 +557,51 @@ class EurostatFilesystem(IFMEWebFilesystem):
         self._log.info('getContainerContents %s', str(args))
         container_key = args.get('CONTAINER_ID')
         
-        if self._tree is None:
-            datasets = [
-                  self._agency.category_schemes_url
-                , self._agency.categorisations_url
-                , self._agency.dataflows_url
-            ]
-            self._tree, self._items = read_catalog(datasets, item_key_func=self.make_dataflow_url_key)
-        
         if 'QUERY' in args:
-            query = args['QUERY'].lower()
-            self._log.info('searching for %s among %s items', query, str(len(self._items)))
-            search_result = [
-                ContainerItem(False, item.id, item.name)
-                for item in self._items.values()
-                if query in item.name.lower()
-            ]
-            #search_result = list(filter(lambda item: query in item.name, self._items))
-            self._log.info('%s items found', str(len(search_result)))
-            return ContainerContentResponse(
-                search_result
-            )
+            query = args['QUERY']
+            if self._last_search is None or query != self._last_search[0]:
+                catalog = self._get_catalog()
+                self._log.info('searching for %s among %s items', query, str(len(catalog.items)))
+                self._last_search = (query, catalog.search(query))
+                self._log.info('%s items found', str(len(self._last_search[1])))
+            return self._make_page(args, self._last_search[1])
         
         if not container_key:
-            return ContainerContentResponse(
-                [
-                    ContainerItem(True, k, v.name)
-                    for k,v in self._tree.items()
-                    if isinstance(v, CategoryScheme)
-                ]
-            )
-        elif container_key in self._tree:
-            container = self._tree[container_key]
+            return self._make_page(args, self._get_catalog(roots_only=True).roots)
+        catalog = self._get_catalog()
+        if container_key in catalog.tree:
+            container = catalog.tree[container_key]
             if not isinstance(container, Container):
                 return ContainerContentResponse([]) 
-            return ContainerContentResponse(
-                [
-                    ContainerItem(isinstance(item, Container), item.id, item.name)
-                    for item in container.children
-                ]
-            )
+            return self._make_page(args, container.children)
         return ContainerContentResponse([])
 
+    def _make_page(self, args, nodes):
+        """
+        Response with the page of `nodes` requested by `LIMIT` and the `OFFSET` of a previous continuation
+
+        Only the nodes of the page are turned into ContainerItems, this is also where
+        dataflow ids get the connection specific `fme://` key. If more nodes follow,
+        the response continues with the same args and the offset of the next page.
+        """
+        try:
+            offset = int(args.get('OFFSET') or 0)
+            limit = int(args.get('LIMIT') or 0)
+        except ValueError as e:
+            self._log.warn('Ignoring invalid paging arguments: %s', e)
+            offset, limit = 0, 0
+        end = offset + limit if limit > 0 else len(nodes)
+        contents = [
+            ContainerItem(True, node.id, node.name)
+            if isinstance(node, Container) else
+            ContainerItem(False, self.make_dataflow_url_key(node.id), node.name)
+            for node in nodes[offset:end]
+        ]
+        continuation_info = None
+        if end < len(nodes):
+            continuation_info = ContinuationInfo(dict(args, OFFSET=end))
+        return ContainerContentResponse(contents, continuation_info)
+
     def downloadFile(self, args):
         """
         Called by Workbench to download a single file.
@@ -307,83 +616,194 @@ class EurostatFilesystem(IFMEWebFilesystem):
 
         :rtype: None
         """
-
-        """
-        https://<api_base_uri>/sdmx/2.1/<resource>/<flowRef>/<key>?startPeriod=value&endPeriod=value
-        The start and end of the time period in the filter are determined as startPeriod and endPeriod. Following time periods are supported:
-            Annual        YYYY-A1 or YYYY
-            Semester      YYYY-S[1-2]
-            Quarter       YYYY-Q[1-4]
-            Monthly       YYYY-M[01-12] or YYYY-[01-12]
-            Weekly        YYYY-W[01-53]
-            Daily         YYYY-D[001-366]
-            Year interval YYYY/P[01-99]Y
-        """
         self._log.info('downloadFile %s', str(args))
         #downloadFile {'FILE_ID': 'FOR_VOL', 'TARGET_FOLDER': 'C:/Users/sepesd/AppData/Local/Temp/wbrun_1675946745961_15424/fmetmp_4/TempFS_1675947095053_14388', 'FILENAME': 'FOR_VOL.csv', 'AGENCY': 'ESTAT'}
-        dataflow_id = args['FILE_ID']
+        dataflow_id = dataflow_id_from_key(args['FILE_ID'])
         target_folder = args['TARGET_FOLDER']
         filename = args['FILENAME']
-        start_period = args.get('START_PERIOD')
-        end_period = args.get('END_PERIOD')
-        first_n_observations = args.get('FIRST_N_OBSERVATIONS')
-        last_n_observations = args.get('LAST_N_OBSERVATIONS')
-
-        params = {
-            'format': 'SDMX-CSV'
-            , 'compressed': 'true'
-        }
+        params = download.data_params(args)
 
-        if start_period and end_period:
-            params['startPeriod'] = start_period
-            params['endPeriod'] = end_period
-        if first_n_observations:
-            try:
-                first_n_observations = int(first_n_observations)
-                params['firstNObservations'] = first_n_observations
-            except Exception as e:
-                self._log.warn(str(e))
-        if last_n_observations:
-            try:
-                last_n_observations = int(last_n_observations)
-                params['lastNObservations'] = last_n_observations
-            except Exception as e:
-                self._log.warn(str(e))
-
-        url = f'{self._agency.base_uri}/sdmx/2.1/data/{dataflow_id}'
+        url = download.data_url(self._agency, dataflow_id)
         self._log.info(' url: %s', url)
         self._log.info(' params: %s', str(params))
-        import os.path
         dst_filepath = os.path.join(target_folder, filename)
+        # Keep the gzip as sent by the server if the file name asks for it
+        ext = '.csv.gz' if filename.lower().endswith('.gz') else '.csv'
+        cache_key = None
+        # Not in the target folder, which is often a user folder, and removed after the download
+        lock_filepath = locks.temp_lock_filepath(dst_filepath)
+        remove_lock = True
+        if self._cache_folder:
+            cache_key = cache.data_key(self._agency.name, dataflow_id, params, self._key_filter(args))
+            lock_filepath = cache.data_filepath(self._cache_folder, cache_key, '.lock')
+            # Kept with the cache entry and removed with it by cache.purge_files
+            remove_lock = False
+        # Of several readers requesting the same data at the same time, in this or other processes,
+        # the first one downloads it and the others wait for it and reuse the file
+        with locks.file_lock(lock_filepath, f'the download of {dataflow_id}', remove=remove_lock):
+            self._download_file(args, dataflow_id, url, params, dst_filepath, ext, cache_key)
+        if self._cache_folder:
+            cache.purge_files(self._cache_folder, self._cache_timeout)
+
+    def _download_file(self, args, dataflow_id, url, params, dst_filepath, ext, cache_key=None):
+        """
+        Download the data into `dst_filepath` unless it is there already, through the data cache if `cache_key` is given
+        """
         if os.path.exists(dst_filepath):
             self._log.warning(' reusing existing file `%s`', dst_filepath)
             return
-        import requests
-        import shutil
-        with requests.get(url, params=params, stream=True) as r:
-            for k,v in r.headers.items():
-                self._log.debug(' response header %s: %s', k, v)
-            r.raise_for_status()
-            content_type = r.headers.get('Content-Type', '')
-            self._log.info(' response status code %s', r.status_code)
-            if not 'csv' in content_type.lower():
-                self._log.error(r.text)
-                raise Exception(r.text)
-            
-            content_disposition_filext = '_UNKNOWN_'
-            content_disposition = r.headers.get('Content-Disposition', '')
-            m = re.match(r'^attachment; filename="[^"]+(\.csv|\.csv\.gz)"$', content_disposition)
-            if m:
-                self._log.info('Response Header Content-Disposition was : `%s`', content_disposition)
-                content_disposition_filext = m.group(1)
-                self._log.info('File extension `%s` will be considered when deciding reading strategy', content_disposition_filext)
-            with open(dst_filepath, 'wb') as f:
-                fin = r.raw
-                if '.csv.gz' == content_disposition_filext:
-                    self._log.info('Reading response using gzip wrapper')
-                    fin = gzip.open(r.raw)
-                shutil.copyfileobj(fin, f)
+        if cache_key:
+            cached_filepath = cache.lookup_file(self._cache_folder, cache_key, self._cache_timeout, ext)
+            if cached_filepath is None:
+                cached_filepath = self._update_cached_file(args, dataflow_id, url, params, cache_key, ext)
+            if cached_filepath:
+                cache.link_file(cached_filepath, dst_filepath)
+                return
+        started = time.time()
+        if not cache_key:
+            self._download(args, dataflow_id, url, params, dst_filepath, compressed='.csv.gz' == ext)
+            sessions.log_stats()
+            return
+        # Downloaded next to the cache entry, so that a later translation can resume an interrupted download
+        download_filepath = cache.partial_filepath(self._cache_folder, cache_key, ext)
+        self._download(args, dataflow_id, url, params, download_filepath, compressed='.csv.gz' == ext)
+        sessions.log_stats()
+        # The offset is measured with the responses of the download
+        info = {'updated': cache.update_checkpoint(started, sessions.clock_offset(url))}
+        cache.store_file(self._cache_folder, cache_key, download_filepath, info=info, ext=ext)
+        cache.link_file(download_filepath, dst_filepath)
+        os.remove(download_filepath)
+
+    def _update_cached_file(self, args, dataflow_id, url, params, cache_key, ext):
+        """
+        Bring an expired cached data file up to date with the observations changed since its download
 
+        Only the changes are requested, with `updatedAfter`, and merged into a new cache entry.
+        Requests with First/Last N Observations are downloaded again instead: a new observation
+        changes which observations are the first or last N of a series.
+
+        :returns: Path of the updated cache entry, or None if the file has to be downloaded again.
+        """
+        cached_filepath, _ = cache.file_entry(self._cache_folder, cache_key, ext)
+        if cached_filepath is None or 'firstNObservations' in params or 'lastNObservations' in params:
+            return None
+        updated_after = cache.load_file_info(self._cache_folder, cache_key, ext).get('updated')
+        if not updated_after:
+            return None
+        self._log.info('Requesting changes to %s since %s', dataflow_id, updated_after)
+        started = time.time()
+        delta_filepath = cache.partial_filepath(self._cache_folder, cache_key, '.delta.csv')
+        merged_filepath = cache.partial_filepath(self._cache_folder, cache_key, f'.merged{ext}')
+        try:
+            changed = self._download(args, dataflow_id, url, dict(params, updatedAfter=updated_after), delta_filepath, missing_ok=True)
+            info = {'updated': cache.update_checkpoint(started, sessions.clock_offset(url))}
+            if not changed:
+                self._log.info('%s not changed since %s', dataflow_id, updated_after)
+                cache.touch_file(self._cache_folder, cache_key, info=info, ext=ext)
+                return cached_filepath
+            download.merge_delta(cached_filepath, delta_filepath, merged_filepath)
+            cache.store_file(self._cache_folder, cache_key, merged_filepath, info=info, ext=ext)
+        except Exception as e:
+            self._log.warn('Updating cached %s failed (%s), downloading it again', dataflow_id, e)
+            return None
+        finally:
+            for filepath in [delta_filepath, merged_filepath]:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+        return cache.file_entry(self._cache_folder, cache_key, ext)[0]
+
+    def _download(self, args, dataflow_id, url, params, dst_filepath, missing_ok=False, compressed=False):
+        """
+        Download the data into `dst_filepath`, split into concurrent requests if configured
+
+        :param bool missing_ok: Return False instead of raising if no observations match the query.
+        :param bool compressed: Write the data gzip compressed.
+        :returns: True if `dst_filepath` has been written.
+        """
+        slices = [
+            period_slice
+            for dimension_slice in self._make_dimension_slices(args, dataflow_id, url, params)
+            for period_slice in self._make_period_slices(args, dimension_slice)
+        ]
+        if len(slices) > 1:
+            return download.download_slices(
+                  slices
+                , dst_filepath
+                , max_workers=self._int_arg(args, 'MAX_WORKERS', download.DEFAULT_MAX_WORKERS)
+                , order=args.get('PARTITION_ORDER') or download.ORDER_PERIOD
+                , missing_ok=missing_ok
+                , compressed=compressed
+            )
+        return download.fetch_csv_retrying(slices[0].url, slices[0].params, dst_filepath, missing_ok=missing_ok, compressed=compressed)
+
+    def _int_arg(self, args, name, default=None):
+        value = args.get(name)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError as e:
+            self._log.warn('Ignoring invalid %s: %s', name, e)
+            return default
+
+    def _key_filter(self, args):
+        """
+        Dimension values given by `SPLIT_DIMENSION` and `SPLIT_VALUES`, an empty dict if all values are read
+        """
+        dimension_id = (args.get('SPLIT_DIMENSION') or '').strip()
+        values = [value.strip() for value in (args.get('SPLIT_VALUES') or '').split(',') if value.strip()]
+        if not (dimension_id and values):
+            return dict()
+        return {dimension_id: values}
+
+    def _make_dimension_slices(self, args, dataflow_id, url, params):
+        """
+        Split the request by the values of the `SPLIT_DIMENSION` dimension, one series key per value
+
+        The values are taken from `SPLIT_VALUES` (comma separated) or else from the codes
+        the dataflow uses for the dimension.
+        """
+        dimension_id = (args.get('SPLIT_DIMENSION') or '').strip()
+        if not dimension_id:
+            return [download.Slice(dataflow_id, url, params)]
+        structure = datastructure.get(
+              self._agency
+            , dataflow_id
+            , cache_folder=self._cache_folder
+            , cache_timeout=self._cache_timeout
+        )
+        values = self._key_filter(args).get(dimension_id) or structure.codes(dimension_id)
+        self._log.info('Splitting %s by %s: %s', dataflow_id, dimension_id, ', '.join(values))
+        return [
+            download.Slice(f'{dimension_id}={value}', f'{url}/{structure.make_key({dimension_id: [value]})}', params)
+            for value in values
+        ]
+
+    def _make_period_slices(self, args, data_slice):
+        """
+        Split a request into startPeriod/endPeriod windows of `PARTITION_YEARS` years
+
+        First/last N observations are counted per series over the whole period,
+        such requests are never split.
+        """
+        params = data_slice.params
+        years = self._int_arg(args, 'PARTITION_YEARS')
+        if not years:
+            return [data_slice]
+        if 'firstNObservations' in params or 'lastNObservations' in params:
+            self._log.warn('Not partitioning a request with First/Last N Observations')
+            return [data_slice]
+        if not ('startPeriod' in params and 'endPeriod' in params):
+            self._log.warn('Partitioning by period needs a Start Period and an End Period')
+            return [data_slice]
+        return [
+            download.Slice(
+                  f'{data_slice.label} {start_period}..{end_period}'
+                , data_slice.url
+                , dict(params, startPeriod=start_period, endPeriod=end_period)
+            )
+            for start_period, end_period in download.period_windows(params['startPeriod'], params['endPeriod'], years)
+        ]
 
     def downloadFolder(self, args):
         """
@@ -397,10 +817,62 @@ class EurostatFilesystem(IFMEWebFilesystem):
             - `TARGET_FOLDER`: Local filesystem folder path to write to.
             - `EXCLUDE_SUB_FOLDERS`: Optional. If this key is present, then subfolders and their contents are not to be downloaded.
 
+        Every dataflow below the category (scheme) is downloaded into a folder tree named after the categories,
+        with the same parameters as `downloadFile`. `MAX_WORKERS` dataflows are downloaded at the same time.
+        Files that already exist in the target folder are skipped. A dataflow that is
+        categorised more than once is downloaded once and linked into its other folders.
+
         :rtype: None
         """
-        raise Exception('not implemented')
-        pass
+        self._log.info('downloadFolder %s', str(args))
+        container = self._get_catalog().tree.get(args['CONTAINER_ID'])
+        if not isinstance(container, Container):
+            raise Exception(f'Unknown category {args["CONTAINER_ID"]}')
+        downloads = dict()      # dataflow id -> folders, in tree order
+        for folder, item in iter_folder_items(container, args['TARGET_FOLDER'], 'EXCLUDE_SUB_FOLDERS' not in args):
+            downloads.setdefault(item.id, []).append(folder)
+        file_args = {k: v for k,v in args.items() if k not in ('CONTAINER_ID', 'TARGET_FOLDER', 'EXCLUDE_SUB_FOLDERS')}
+
+        def download_worker(entry):
+            dataflow_id, folder = entry
+            filename = f'{dataflow_id}{self._file_ext}'
+            if os.path.exists(os.path.join(folder, filename)):
+                return PoolWorkerResult(success=False, reference=dataflow_id, error='FILE_EXISTS')
+            try:
+                os.makedirs(folder, exist_ok=True)
+                self.downloadFile(dict(file_args, FILE_ID=dataflow_id, TARGET_FOLDER=folder, FILENAME=filename))
+                return PoolWorkerResult(success=True, reference=dataflow_id, error=None)
+            except Exception as e:
+                return PoolWorkerResult(success=False, reference=dataflow_id, error=e)
+
+        failed = []
+        def handler(results):
+            downloaded = skipped = 0
+            for i, result in enumerate(results, 1):
+                if result.success:
+                    downloaded += 1
+                elif 'FILE_EXISTS' == result.error:
+                    skipped += 1
+                else:
+                    failed.append(result.reference)
+                    self._log.error('Downloading %s failed: %s', result.reference, result.error)
+                self._log.info('%s of %s dataflows processed: %s downloaded, %s skipped, %s failed', i, len(downloads), downloaded, skipped, len(failed))
+
+        map_to_new_pool(
+              [(dataflow_id, folders[0]) for dataflow_id, folders in downloads.items()]
+            , download_worker
+            , handler
+            , self._int_arg(args, 'MAX_WORKERS', download.DEFAULT_MAX_WORKERS)
+        )
+        for dataflow_id, (folder, *other_folders) in downloads.items():
+            filename = f'{dataflow_id}{self._file_ext}'
+            for other_folder in other_folders:
+                if os.path.exists(os.path.join(folder, filename)) and not os.path.exists(os.path.join(other_folder, filename)):
+                    os.makedirs(other_folder, exist_ok=True)
+                    cache.link_file(os.path.join(folder, filename), os.path.join(other_folder, filename))
+        sessions.log_stats()
+        if failed:
+            raise Exception(f'Downloading {len(failed)} of {len(downloads)} dataflows failed: {", ".join(failed)}')
 
     def get_item_info(self, item_id, **kwargs):
         """
@@ -411,14 +883,53 @@ class EurostatFilesystem(IFMEWebFilesystem):
         :rtype: IContainerItem
         """
         self._log.warn('get_item_info %s %s', item_id, str(kwargs))
-        if self._tree is None:
-            datasets = [
-                  self._agency.category_schemes_url
-                , self._agency.categorisations_url
-                , self._agency.dataflows_url
-            ]
-            self._tree, self._items = read_catalog(datasets, item_key_func=self.make_dataflow_url_key)
-        item = self._tree.get(item_id, self._items.get(item_id))
-        if not item:
+        catalog = self._get_catalog()
+        item = catalog.tree.get(item_id)
+        if item is not None:
+            return ContainerItem(isinstance(item, Container), item.id, item.name)
+        item = catalog.items.get(dataflow_id_from_key(item_id))
+        if item is None:
             return None
-        return ContainerItem(Container == type(item), item.id, item.name)
+        return ContainerItem(False, self.make_dataflow_url_key(item.id), item.name)
+
+
+if __name__ == '__main__':
+    '''
+    Benchmark of the native parser against the FME XML reader on recorded structure messages:
+
+    python -m fmepy_eurostat.catalog --record fixtures --agency ESTAT
+    python -m fmepy_eurostat.catalog fixtures/ESTAT_categoryschemes.xml fixtures/ESTAT_categorisations.xml fixtures/ESTAT_dataflows.xml
+    '''
+    import argparse
+    import shutil
+    import time
+    from fmeobjects import FMELogFile
+    parser = argparse.ArgumentParser(description='Compare the native and the xfmap catalog parsers')
+    parser.add_argument('fixtures', nargs='*', help='category schemes, categorisations and dataflows documents')
+    parser.add_argument('--record', metavar='FOLDER', help='download the documents of the agency into FOLDER and use them as fixtures')
+    parser.add_argument('--agency', default='ESTAT', choices=[agency.name for agency in Agency])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    log = FMELogFile()
+    log.setCallBack(print)
+    fixtures = args.fixtures
+    if args.record:
+        agency = Agency[args.agency]
+        os.makedirs(args.record, exist_ok=True)
+        fixtures = []
+        for name, url in [
+              ('categoryschemes', agency.category_schemes_url)
+            , ('categorisations', agency.categorisations_url)
+            , ('dataflows', agency.dataflows_url)
+        ]:
+            filepath = os.path.join(args.record, f'{agency.name}_{name}.xml')
+            with open_structure(url) as (fin, _), open(filepath, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            fixtures.append(filepath)
+    for label, use_xfmap in [('native', False), ('xfmap', True)]:
+        timings = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            catalog = read_catalog(fixtures, use_xfmap=use_xfmap)
+            timings.append(time.perf_counter() - t0)
+        print(f'{label:8} containers: {len(catalog.tree):6} items: {len(catalog.items):6} best: {min(timings):8.3f}s mean: {sum(timings)/len(timings):8.3f}s')
@@ -2,7 +2,10 @@
 Get the name, descriptions and annotations for a specified codelist:
 https://ec.europa.eu/eurostat/api/dissemination/sdmx/2.1/codelist/ESTAT/AIRPOL?detail=referencestubs&completestub=true
 '''
-from .constants import Agency
+from .constants import Agency, LOG_NAME, DEFAULT_CACHE_TIMEOUT
+from . import cache
+from .sdmx import CodeRecord, NotModified, open_structure, parse_codelists
+from concurrent.futures import ThreadPoolExecutor
 from fmeobjects import FMESession, FMEFeature, FMEFactoryPipeline
 from fmegeneral.fmelog import get_configured_logger
 import os.path
@@ -11,6 +14,9 @@ import os.path
 # from typing import List
 from dataclasses import dataclass
 
+CODELIST_CACHE_VERSION = 1
+MAX_WORKERS = 4
+
 @dataclass
 class CodeList:
     agencyID: str
@@ -25,10 +31,14 @@ class CodeList:
         return f'CodeList(name={self.name}, id={self.id}, version={self.version}, values: {len(self.values)})'
 
 
-def get(agency: Agency, codelist_ids: list, lang='en') -> "list[CodeList]":
+def get(agency: Agency, codelist_ids: list, lang='en', cache_folder=None, cache_timeout=DEFAULT_CACHE_TIMEOUT, use_xfmap=False) -> "list[CodeList]":
     """
     Download and interpret codelist xml files
 
+    With a `cache_folder` every codelist is cached separately together with the
+    ETag/Last-Modified of its document. Expired entries are revalidated with a
+    conditional request and reused as they are if the codelist did not change.
+
     example usage:
     
     from fmepy_eurostat import codelists
@@ -36,6 +46,59 @@ def get(agency: Agency, codelist_ids: list, lang='en') -> "list[CodeList]":
 
     geo_codelist, *_ = codelists.get(Agency.ESTAT, ['GEO'], lang='en')
 
+    """
+    if use_xfmap:
+        return _get_xfmap(agency, codelist_ids, lang)
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(codelist_ids)))) as executor:
+        return list(executor.map(
+            lambda id: _get_native(agency, id, lang, cache_folder, cache_timeout)
+            , codelist_ids
+        ))
+
+def codelist_url(agency: Agency, id):
+    return f'{agency.base_uri}/sdmx/2.1/codelist/ESTAT/{id}?detail=referencestubs&completestub=true'
+
+def _get_native(agency: Agency, id, lang, cache_folder, cache_timeout) -> CodeList:
+    """
+    Read a single codelist with the native SDMX-ML parser, using the cache folder if given
+    """
+    logger = get_configured_logger(LOG_NAME)
+    cache_name = f'codelist_{agency.name}_{id}_{lang}'
+    cached = None
+    if cache_folder:
+        payload, age = cache.load_entry(cache_folder, cache_name)
+        if payload and CODELIST_CACHE_VERSION == payload.get('version'):
+            if age <= cache_timeout:
+                return payload['codelist']
+            cached = payload
+    dataset = codelist_url(agency, id)
+    logger.info('Reading dataset `%s`', dataset)
+    codelist = CodeList(agency.name, id, None, None, None, None, dict())
+    try:
+        with open_structure(dataset, cached['validators'] if cached else None) as (fin, validators):
+            for record in parse_codelists(fin, lang):
+                if isinstance(record, CodeRecord):
+                    codelist.values[record.id] = record.name
+                elif id == record.id:
+                    codelist.isFinal = record.is_final
+                    codelist.urn = record.urn
+                    codelist.version = record.version
+                    codelist.name = record.name
+    except NotModified:
+        logger.info('Codelist %s not modified, reusing cached codelist', id)
+        cache.touch(cache_folder, cache_name)
+        return cached['codelist']
+    if cache_folder:
+        cache.save(cache_folder, cache_name, {
+              'version': CODELIST_CACHE_VERSION
+            , 'codelist': codelist
+            , 'validators': validators
+        })
+    return codelist
+
+def _get_xfmap(agency: Agency, codelist_ids: list, lang='en') -> "list[CodeList]":
+    """
+    Read the codelists with the FME XML reader and xfmap/codelist.xmp
     """
     logger = get_configured_logger('codelist')
     session = FMESession()
@@ -74,7 +137,7 @@ def get(agency: Agency, codelist_ids: list, lang='en') -> "list[CodeList]":
 
     for id in codelist_ids:
         feature = FMEFeature()
-        dataset = f'{agency.base_uri}/sdmx/2.1/codelist/ESTAT/{id}?detail=referencestubs&completestub=true'
+        dataset = codelist_url(agency, id)
         feature.setAttribute('dataset', dataset)
         feature.setAttribute('codelist_id', id)
         logger.info('Reading dataset `%s`', dataset)
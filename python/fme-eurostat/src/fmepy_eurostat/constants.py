@@ -3,6 +3,8 @@ from enum import Enum, unique
 LOG_NAME = "Eurostat"
 PACKAGE_KEYWORD = "EUROSTAT"
 DELIM = "/"
+# Used when the named connection does not specify CACHE_TIMEOUT (seconds)
+DEFAULT_CACHE_TIMEOUT = 6 * 60 * 60
 
 @unique
 class Agency(Enum):
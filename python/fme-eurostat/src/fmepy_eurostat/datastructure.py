@@ -0,0 +1,140 @@
+'''
+Get the dimensions of a dataflow and the codes it uses for them:
+https://ec.europa.eu/eurostat/api/dissemination/sdmx/2.1/dataflow/ESTAT/NAMA_10_GDP?references=descendants&detail=referencepartial
+
+With `detail=referencepartial` the codelists only contain the codes that actually
+occur in the dataflow, not every code of the (often agency-wide) codelist.
+'''
+from dataclasses import dataclass, field
+
+from fmegeneral.fmelog import get_configured_logger
+
+from . import cache
+from .codelists import CodeList
+from .constants import Agency, LOG_NAME, DEFAULT_CACHE_TIMEOUT
+from .sdmx import (
+    CodeRecord,
+    CodelistRecord,
+    ComponentRecord,
+    DimensionRecord,
+    NotModified,
+    open_structure,
+    parse_data_structure
+)
+
+# Increment whenever the structure of the cached DataStructure changes
+STRUCTURE_CACHE_VERSION = 2
+# Separates the dimensions of a series key, alternative values of one dimension are joined with `+`
+KEY_SEPARATOR = '.'
+VALUE_SEPARATOR = '+'
+
+@dataclass
+class DataStructure:
+    dataflow_id: str
+    dimensions: list    # DimensionRecord in series key order
+    codelists: dict     # CodeList by id
+    components: list = field(default_factory=list)     # ComponentRecord in document order
+
+    def columns(self):
+        """
+        Components in the column order of SDMX-CSV: dimensions, time dimension, primary measure, attributes
+
+        :returns: List of (id, text_type) tuples, text_type is None for coded components.
+        """
+        order = ['TimeDimension', 'PrimaryMeasure', 'Attribute']
+        return [(dimension.id, None) for dimension in self.dimensions] + [
+            (component.id, None if component.codelist_id else component.text_type)
+            for component in sorted(self.components, key=lambda component: order.index(component.kind))
+        ]
+
+    def find_dimension(self, dimension_id):
+        """
+        Dimension by id, ignoring case since SDMX-CSV columns are lower case
+        """
+        for dimension in self.dimensions:
+            if dimension.id.upper() == dimension_id.upper():
+                return dimension
+        return None
+
+    def codes(self, dimension_id):
+        """
+        Codes of a dimension in codelist order
+        """
+        dimension = self.find_dimension(dimension_id)
+        if dimension is None:
+            raise Exception(f'Dataflow {self.dataflow_id} has no dimension {dimension_id}')
+        codelist = self.codelists.get(dimension.codelist_id)
+        return list(codelist.values) if codelist else []
+
+    def make_key(self, filters):
+        """
+        Series key path of a data query: {'GEO': ['AT', 'BE']} -> `..AT+BE..`
+
+        :param dict filters: Values by dimension id, dimensions not given are not filtered.
+        """
+        values = {dimension_id.upper(): dimension_values for dimension_id, dimension_values in filters.items()}
+        for dimension_id in values:
+            if self.find_dimension(dimension_id) is None:
+                raise Exception(f'Dataflow {self.dataflow_id} has no dimension {dimension_id}')
+        return KEY_SEPARATOR.join(
+            VALUE_SEPARATOR.join(values.get(dimension.id.upper(), []))
+            for dimension in self.dimensions
+        )
+
+def structure_url(agency: Agency, dataflow_id):
+    return f'{agency.base_uri}/sdmx/2.1/dataflow/{agency.name}/{dataflow_id}?references=descendants&detail=referencepartial'
+
+def get(agency: Agency, dataflow_id, lang='en', cache_folder=None, cache_timeout=DEFAULT_CACHE_TIMEOUT) -> DataStructure:
+    """
+    Download and interpret the data structure of a dataflow
+
+    Like codelists, the structure is cached in `cache_folder` and revalidated
+    with a conditional request once it has expired.
+    """
+    log = get_configured_logger(LOG_NAME)
+    cache_name = f'structure_{agency.name}_{dataflow_id}_{lang}'
+    cached = None
+    if cache_folder:
+        payload, age = cache.load_entry(cache_folder, cache_name)
+        if payload and STRUCTURE_CACHE_VERSION == payload.get('version'):
+            if age <= cache_timeout:
+                return payload['structure']
+            cached = payload
+    dataset = structure_url(agency, dataflow_id)
+    log.info('Reading dataset `%s`', dataset)
+    dimensions = []
+    components = []
+    codelists = dict()
+    values = dict()
+    try:
+        with open_structure(dataset, cached['validators'] if cached else None) as (fin, validators):
+            for record in parse_data_structure(fin, lang):
+                if isinstance(record, DimensionRecord):
+                    dimensions.append(record)
+                elif isinstance(record, ComponentRecord):
+                    components.append(record)
+                elif isinstance(record, CodeRecord):
+                    values.setdefault(record.codelist_id, dict())[record.id] = record.name
+                elif isinstance(record, CodelistRecord):
+                    codelists[record.id] = CodeList(
+                          record.agency_id
+                        , record.id
+                        , record.is_final
+                        , record.urn
+                        , record.version
+                        , record.name
+                        , values.pop(record.id, dict())
+                    )
+    except NotModified:
+        log.info('Data structure of %s not modified, reusing cached structure', dataflow_id)
+        cache.touch(cache_folder, cache_name)
+        return cached['structure']
+    dimensions.sort(key=lambda dimension: dimension.position)
+    structure = DataStructure(dataflow_id, dimensions, codelists, components)
+    if cache_folder:
+        cache.save(cache_folder, cache_name, {
+              'version': STRUCTURE_CACHE_VERSION
+            , 'structure': structure
+            , 'validators': validators
+        })
+    return structure
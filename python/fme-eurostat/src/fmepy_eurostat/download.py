@@ -0,0 +1,625 @@
+'''
+Download of SDMX-CSV data, either with a single request or split into slices.
+
+A sliced download sends one request per slice (a window of years, a series key
+or both) to a bounded pool of workers. Every slice is streamed into its own temporary file next to the
+destination, the slices are then merged into one SDMX-CSV file with a single header.
+The merged file only appears under its final name once it is complete.
+
+Responses are received into `.part` files, next to a manifest with the expected and the
+received number of bytes. An interrupted download is resumed with a range request if
+the server supports it, a sliced download by requesting only the slices that are missing.
+'''
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from fmegeneral.fmelog import get_configured_logger
+
+from . import asyncjobs, sessions
+from .constants import LOG_NAME
+
+REQUEST_TIMEOUT = 300
+DEFAULT_MAX_WORKERS = 4
+# A failing request is sent again, after 2, 4, ... seconds
+FETCH_ATTEMPTS = 3
+# Partial downloads and the manifests describing them, which are saved every CHECKPOINT_BYTES
+PART_SUFFIX = '.part'
+MANIFEST_SUFFIX = '.part.json'
+CHECKPOINT_BYTES = 16 * 1024 * 1024
+# Slices are merged in the order they were defined, or in the order they complete
+ORDER_PERIOD = 'PERIOD'
+ORDER_COMPLETION = 'COMPLETION'
+YEAR_PATTERN = re.compile(r'^(\d{4})')
+# SDMX-CSV columns that are not part of the series key, ACTION `D` in a delta deletes an observation
+TIME_PERIOD = 'TIME_PERIOD'
+NON_KEY_COLUMNS = {'DATAFLOW', 'LAST UPDATE', 'ACTION'}
+ACTION = 'ACTION'
+ACTION_DELETE = 'D'
+
+@dataclass
+class Slice:
+    label: str
+    url: str
+    params: dict
+
+def data_url(agency, dataflow_id):
+    return f'{agency.base_uri}/sdmx/2.1/data/{dataflow_id}'
+
+def data_params(args):
+    """
+    Query parameters of a data request from the reader parameters START_PERIOD, END_PERIOD,
+    FIRST_N_OBSERVATIONS and LAST_N_OBSERVATIONS
+
+    https://<api_base_uri>/sdmx/2.1/<resource>/<flowRef>/<key>?startPeriod=value&endPeriod=value
+    The start and end of the time period in the filter are determined as startPeriod and endPeriod. Following time periods are supported:
+        Annual        YYYY-A1 or YYYY
+        Semester      YYYY-S[1-2]
+        Quarter       YYYY-Q[1-4]
+        Monthly       YYYY-M[01-12] or YYYY-[01-12]
+        Weekly        YYYY-W[01-53]
+        Daily         YYYY-D[001-366]
+        Year interval YYYY/P[01-99]Y
+    """
+    log = get_configured_logger(LOG_NAME)
+    start_period = args.get('START_PERIOD')
+    end_period = args.get('END_PERIOD')
+    first_n_observations = args.get('FIRST_N_OBSERVATIONS')
+    last_n_observations = args.get('LAST_N_OBSERVATIONS')
+
+    params = {
+        'format': 'SDMX-CSV'
+        , 'compressed': 'true'
+    }
+
+    if start_period and end_period:
+        params['startPeriod'] = start_period
+        params['endPeriod'] = end_period
+    if first_n_observations:
+        try:
+            first_n_observations = int(first_n_observations)
+            params['firstNObservations'] = first_n_observations
+        except Exception as e:
+            log.warn(str(e))
+    if last_n_observations:
+        try:
+            last_n_observations = int(last_n_observations)
+            params['lastNObservations'] = last_n_observations
+        except Exception as e:
+            log.warn(str(e))
+    return params
+
+def period_windows(start_period, end_period, years):
+    """
+    Split the period between `start_period` and `end_period` into windows of `years` years
+
+    The first window keeps the original start and the last window the original end,
+    the windows in between are whole years, so together they cover exactly the same
+    observations as the original period: `2001-06`, `2010`, 4 -> (`2001-06`, `2004`), (`2005`, `2008`), (`2009`, `2010`)
+
+    :returns: List of (startPeriod, endPeriod) tuples, a single window if the period cannot be split.
+    """
+    m_start = YEAR_PATTERN.match(start_period or '')
+    m_end = YEAR_PATTERN.match(end_period or '')
+    if not (m_start and m_end) or years < 1:
+        return [(start_period, end_period)]
+    start_year = int(m_start.group(1))
+    end_year = int(m_end.group(1))
+    windows = []
+    window_start = start_period
+    year = start_year + years
+    while year <= end_year:
+        windows.append((window_start, str(year - 1)))
+        window_start = str(year)
+        year += years
+    windows.append((window_start, end_period))
+    return windows
+
+class IncompleteDownload(Exception):
+    """
+    The response ended before all of its announced Content-Length was received
+    """
+
+def part_filepath(dst_filepath):
+    return f'{dst_filepath}{PART_SUFFIX}'
+
+def manifest_filepath(dst_filepath):
+    return f'{dst_filepath}{MANIFEST_SUFFIX}'
+
+def _query(url, params):
+    # Normalized as read back from json, so that a stored query compares equal
+    return json.loads(json.dumps({'url': url, 'params': params or dict()}))
+
+def _save_manifest(dst_filepath, manifest):
+    filepath = manifest_filepath(dst_filepath)
+    with open(f'{filepath}.tmp', 'w', encoding='utf8') as f:
+        json.dump(manifest, f)
+    os.replace(f'{filepath}.tmp', filepath)
+
+def _load_manifest(dst_filepath, url, params):
+    """
+    Manifest of an interrupted download of the same query into `dst_filepath`
+
+    :returns: The manifest if the download can be resumed with a range request, None otherwise.
+    """
+    try:
+        with open(manifest_filepath(dst_filepath), encoding='utf8') as f:
+            manifest = json.load(f)
+        size = os.path.getsize(part_filepath(dst_filepath))
+    except (OSError, ValueError):
+        return None
+    if manifest.get('query') != _query(url, params) or not manifest.get('ranges') or not manifest.get('validator'):
+        return None
+    received = manifest.get('received') or 0
+    if not 0 < received <= size or (manifest.get('expected') is not None and received > manifest['expected']):
+        return None
+    return manifest
+
+def remove_partial(dst_filepath):
+    """
+    Remove the partial download of `dst_filepath` and its manifest
+    """
+    for filepath in [part_filepath(dst_filepath), manifest_filepath(dst_filepath)]:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+def _content_encoding(r):
+    encoding = r.headers.get('Content-Encoding', '').strip().lower()
+    return '' if 'identity' == encoding else encoding
+
+def _range_validator(r):
+    """
+    Validator for If-Range, which takes a single one: a strong ETag, otherwise Last-Modified
+    """
+    etag = r.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return r.headers.get('Last-Modified')
+
+def _content_range_start(r):
+    m = re.match(r'^bytes (\d+)-', r.headers.get('Content-Range', ''))
+    return int(m.group(1)) if m else None
+
+def _receive(r, dst_filepath, manifest, resume):
+    """
+    Append the body of the response `r`, as received, to the partial download of `dst_filepath`
+
+    The manifest is saved every CHECKPOINT_BYTES and when the transfer stops,
+    so its `received` is the offset a later request can resume at.
+    """
+    with open(part_filepath(dst_filepath), 'r+b' if resume else 'wb') as f:
+        if resume:
+            f.truncate(manifest['received'])
+            f.seek(manifest['received'])
+        checkpoint = f.tell()
+        try:
+            while True:
+                data = r.raw.read(shutil.COPY_BUFSIZE, decode_content=False)
+                if not data:
+                    break
+                f.write(data)
+                if f.tell() - checkpoint >= CHECKPOINT_BYTES:
+                    f.flush()
+                    checkpoint = manifest['received'] = f.tell()
+                    _save_manifest(dst_filepath, manifest)
+        finally:
+            f.flush()
+            manifest['received'] = f.tell()
+            _save_manifest(dst_filepath, manifest)
+    if manifest['expected'] is not None and manifest['received'] != manifest['expected']:
+        raise IncompleteDownload(f'Received {manifest["received"]} of {manifest["expected"]} bytes of {r.url}')
+
+def _complete(dst_filepath, manifest, compressed):
+    """
+    Turn a completely received partial download into `dst_filepath`
+
+    The body is kept as received if it already has the requested compression,
+    otherwise it is inflated or compressed into its final name.
+    """
+    log = get_configured_logger(LOG_NAME)
+    src_filepath = part_filepath(dst_filepath)
+    gzipped = '.csv.gz' == manifest['filext']
+    if compressed == gzipped and not manifest['encoding']:
+        os.replace(src_filepath, dst_filepath)
+        os.remove(manifest_filepath(dst_filepath))
+        return
+    tmp_filepath = f'{dst_filepath}.tmp'
+    try:
+        with open(src_filepath, 'rb') as fin, open(tmp_filepath, 'wb') as f:
+            if manifest['encoding']:
+                # Accept-Encoding is identity, gzip is the only encoding the server is known to apply regardless
+                if manifest['encoding'] not in ('gzip', 'x-gzip'):
+                    raise Exception(f'Unsupported Content-Encoding {manifest["encoding"]}')
+                fin = gzip.GzipFile(fileobj=fin)
+            if gzipped and not compressed:
+                log.info('Reading response using gzip wrapper')
+                fin = gzip.GzipFile(fileobj=fin)
+            fout = f
+            if compressed and not gzipped:
+                log.info('Writing response using gzip wrapper')
+                fout = gzip.GzipFile(fileobj=f, mode='wb')
+            shutil.copyfileobj(fin, fout)
+            if fout is not f:
+                fout.close()
+        os.replace(tmp_filepath, dst_filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+    remove_partial(dst_filepath)
+
+def _queued_job_url(r, url):
+    """
+    Wait for the asynchronous job if the server queued the query instead of answering with SDMX-CSV
+
+    :returns: Url of the data of the finished job, None if `r` is the SDMX-CSV data itself.
+    """
+    log = get_configured_logger(LOG_NAME)
+    if 'csv' in r.headers.get('Content-Type', '').lower():
+        return None
+    job_key = asyncjobs.parse_queued(r.text)
+    if job_key is None:
+        log.error(r.text)
+        raise Exception(r.text)
+    log.info('Query queued by the server as asynchronous job %s', job_key)
+    return asyncjobs.JOBS.wait(asyncjobs.async_base_uri(url), job_key)
+
+def _attachment_filext(r):
+    """
+    `.csv` or `.csv.gz` from the Content-Disposition of a data response, `_UNKNOWN_` without attachment
+    """
+    log = get_configured_logger(LOG_NAME)
+    content_disposition = r.headers.get('Content-Disposition', '')
+    m = re.match(r'^attachment; filename="[^"]+(\.csv|\.csv\.gz)"$', content_disposition)
+    if not m:
+        return '_UNKNOWN_'
+    log.info('Response Header Content-Disposition was : `%s`', content_disposition)
+    log.info('File extension `%s` will be considered when deciding reading strategy', m.group(1))
+    return m.group(1)
+
+def fetch_csv(url, params, dst_filepath, missing_ok=False, compressed=False):
+    """
+    Stream an SDMX-CSV response into `dst_filepath`, inflating a gzipped attachment
+
+    With `compressed` a gzipped attachment is written as it is received
+    and an uncompressed one is compressed while it is written.
+
+    The response is received into `{dst_filepath}.part`, described by the manifest
+    `{dst_filepath}.part.json` (query, expected length, received bytes, validators).
+    `dst_filepath` only appears once the whole response has been received, a short response
+    raises IncompleteDownload. If the server supports range requests, fetching the same
+    query again resumes an interrupted download at the last received byte.
+
+    If the server queues the query as an asynchronous job, the data is fetched
+    once the job is available.
+
+    :param bool missing_ok: Treat 404 Not Found (no observations match the query) as an empty result.
+    :returns: False if the response was 404 and `missing_ok`, True otherwise.
+    """
+    log = get_configured_logger(LOG_NAME)
+    manifest = _load_manifest(dst_filepath, url, params)
+    # Range offsets refer to the body as sent, it is stored without transfer encoding
+    headers = {'Accept-Encoding': 'identity'}
+    if manifest:
+        if manifest['expected'] == manifest['received']:
+            _complete(dst_filepath, manifest, compressed)
+            return True
+        headers['Range'] = f'bytes={manifest["received"]}-'
+        headers['If-Range'] = manifest['validator']
+    with sessions.get(url, params=params, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as r:
+        for k,v in r.headers.items():
+            log.debug(' response header %s: %s', k, v)
+        if missing_ok and 404 == r.status_code:
+            log.info(' no data for %s %s', url, str(params))
+            remove_partial(dst_filepath)
+            return False
+        if manifest and 416 == r.status_code:
+            log.warn('Unable to resume download of `%s`, starting again', dst_filepath)
+            remove_partial(dst_filepath)
+            return fetch_csv(url, params, dst_filepath, missing_ok, compressed)
+        r.raise_for_status()
+        log.info(' response status code %s', r.status_code)
+        job_data_url = _queued_job_url(r, url)
+        if job_data_url:
+            return fetch_csv(job_data_url, None, dst_filepath, missing_ok, compressed)
+
+        resume = bool(manifest) and 206 == r.status_code and manifest['received'] == _content_range_start(r)
+        if resume:
+            log.info('Resuming download of `%s` at byte %s', dst_filepath, manifest['received'])
+        else:
+            content_length = r.headers.get('Content-Length')
+            manifest = {
+                  'query': _query(url, params)
+                , 'filext': _attachment_filext(r)
+                , 'encoding': _content_encoding(r)
+                , 'expected': int(content_length) if content_length and content_length.isdigit() else None
+                , 'received': 0
+                , 'ranges': 'bytes' == r.headers.get('Accept-Ranges')
+                , 'validator': _range_validator(r)
+            }
+        _receive(r, dst_filepath, manifest, resume)
+    _complete(dst_filepath, manifest, compressed)
+    return True
+
+def fetch_csv_retrying(url, params, dst_filepath, missing_ok=False, compressed=False, label=None):
+    """
+    `fetch_csv` that requests the data again if the request fails or the transfer breaks off
+
+    Every attempt resumes the partial download of the previous one where possible.
+    """
+    import requests
+    import urllib3
+    log = get_configured_logger(LOG_NAME)
+    label = label or url
+    for attempt in range(1, FETCH_ATTEMPTS + 1):
+        try:
+            return fetch_csv(url, params, dst_filepath, missing_ok, compressed)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, IncompleteDownload) as e:
+            response = getattr(e, 'response', None)
+            status_code = response.status_code if response is not None else None
+            if attempt == FETCH_ATTEMPTS or (status_code and status_code < 500):
+                # A rejected query fails the same way every time
+                raise
+            log.warn('Downloading %s failed (%s), attempt %s of %s', label, e, attempt + 1, FETCH_ATTEMPTS)
+            time.sleep(2 ** attempt)
+
+@contextmanager
+def open_csv(url, params):
+    """
+    Open the SDMX-CSV response to a data query as a text stream, inflated while it is read
+
+    Nothing is written to disk, only the chunk being decoded is held in memory.
+    An asynchronous job is waited for as in `fetch_csv`.
+
+    :returns: Context manager for the text stream, None if no observations match the query (404).
+    """
+    log = get_configured_logger(LOG_NAME)
+    with sessions.get(url, params=params, stream=True, timeout=REQUEST_TIMEOUT) as r:
+        if 404 == r.status_code:
+            log.info(' no data for %s %s', url, str(params))
+            yield None
+            return
+        r.raise_for_status()
+        log.info(' response status code %s', r.status_code)
+        job_data_url = _queued_job_url(r, url)
+        if job_data_url:
+            with open_csv(job_data_url, None) as fin:
+                yield fin
+            return
+        r.raw.decode_content = True
+        fin = r.raw
+        if '.csv.gz' == _attachment_filext(r):
+            fin = gzip.GzipFile(fileobj=r.raw)
+        yield io.TextIOWrapper(fin, encoding='utf-8-sig', newline='')
+
+def iter_csv_rows(url, params):
+    """
+    Stream the SDMX-CSV response to a data query row by row
+
+    :returns: Generator of the header followed by the rows, as lists of strings.
+        Nothing is generated if no observations match the query.
+    """
+    with open_csv(url, params) as fin:
+        if fin is None:
+            return
+        yield from csv.reader(fin)
+
+def _fetch_slice(data_slice, dst_filepath):
+    """
+    Fetch a single slice, retrying only this slice if the request fails
+
+    A slice file that is already there has been completed by an earlier, interrupted download.
+    """
+    log = get_configured_logger(LOG_NAME)
+    if os.path.exists(dst_filepath):
+        log.info('Slice %s already downloaded', data_slice.label)
+        return True
+    log.info('Downloading slice %s', data_slice.label)
+    found = fetch_csv_retrying(data_slice.url, data_slice.params, dst_filepath, missing_ok=True, label=f'slice {data_slice.label}')
+    log.info('Slice %s done', data_slice.label)
+    return found
+
+def slice_filepath(dst_filepath, data_slice):
+    """
+    Download location of a slice, named after its query so that a repeated download finds its completed slices
+    """
+    folder, filename = os.path.split(dst_filepath)
+    query = json.dumps(_query(data_slice.url, data_slice.params), sort_keys=True).encode('utf8')
+    return os.path.join(folder, f'.{filename}.{hashlib.sha256(query).hexdigest()[:16]}.slice')
+
+class _Merger:
+    '''
+    Appends slice files to the merged file, writing the SDMX-CSV header only once
+    '''
+    def __init__(self, fout):
+        self._fout = fout
+        self._header = None
+        self._ends_with_newline = True
+
+    def append(self, label, filepath):
+        with open(filepath, 'rb') as fin:
+            header = fin.readline()
+            if not header:
+                return
+            if self._header is None:
+                self._header = header
+                self._fout.write(header)
+            elif header.rstrip(b'\r\n') != self._header.rstrip(b'\r\n'):
+                raise Exception(f'Slice {label} has a different header: {header!r}')
+            chunk = None
+            while True:
+                data = fin.read(shutil.COPY_BUFSIZE)
+                if not data:
+                    break
+                if not self._ends_with_newline:
+                    self._fout.write(b'\n')
+                    self._ends_with_newline = True
+                self._fout.write(data)
+                chunk = data
+            if chunk is not None:
+                self._ends_with_newline = chunk.endswith(b'\n')
+
+    @property
+    def empty(self):
+        return self._header is None
+
+def download_slices(slices, dst_filepath, max_workers=DEFAULT_MAX_WORKERS, order=ORDER_PERIOD, missing_ok=False, compressed=False):
+    """
+    Fetch `slices` concurrently and merge them into the SDMX-CSV file `dst_filepath`
+
+    Slices without observations (404) are skipped. If any slice fails, the others are
+    cancelled and the error is raised, `dst_filepath` is not created then.
+    The completed slices are kept until they have been merged, downloading the same
+    slices into `dst_filepath` again only requests the slices that are missing.
+
+    :param list slices: Slice objects, their order is the row order of `ORDER_PERIOD`.
+    :param int max_workers: Maximum number of concurrent requests.
+    :param str order: `ORDER_PERIOD` keeps the order of `slices`, `ORDER_COMPLETION` appends
+        every slice as soon as it is downloaded and needs no slice to wait for another.
+    :param bool missing_ok: Return False instead of raising if none of the slices has observations.
+    :param bool compressed: The slices are downloaded uncompressed to find their headers,
+        the merged file is gzip compressed while it is written.
+    :returns: True if `dst_filepath` has been written.
+    """
+    log = get_configured_logger(LOG_NAME)
+    folder, filename = os.path.split(dst_filepath)
+    log.info('Downloading %s in %s slices with %s workers', filename, len(slices), max_workers)
+    slice_filepaths = [slice_filepath(dst_filepath, data_slice) for data_slice in slices]
+    fd, merged_filepath = tempfile.mkstemp(prefix=f'.{filename}.', suffix='.tmp', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f, ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            fout = gzip.GzipFile(fileobj=f, mode='wb') if compressed else f
+            merger = _Merger(fout)
+            futures = {
+                executor.submit(_fetch_slice, data_slice, filepath): i
+                for i, (data_slice, filepath) in enumerate(zip(slices, slice_filepaths))
+            }
+            completed = dict()
+            next_index = 0
+            try:
+                for future in as_completed(futures):
+                    i = futures[future]
+                    completed[i] = future.result()
+                    if ORDER_COMPLETION == order:
+                        ready = [i]
+                    else:
+                        # Append the slices that are next in line, the others wait for their predecessors
+                        ready = []
+                        while next_index in completed:
+                            ready.append(next_index)
+                            next_index += 1
+                    for j in ready:
+                        if completed[j]:
+                            merger.append(slices[j].label, slice_filepaths[j])
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+            if compressed:
+                fout.close()
+        if merger.empty:
+            if missing_ok:
+                return False
+            raise Exception(f'No results found for {filename}')
+        os.replace(merged_filepath, dst_filepath)
+        for filepath in slice_filepaths:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+    finally:
+        if os.path.exists(merged_filepath):
+            os.remove(merged_filepath)
+    log.info('Merged %s slices into `%s`', len(slices), dst_filepath)
+    return True
+
+def series_key_indexes(header):
+    """
+    Positions of the series key dimensions in an SDMX-CSV header
+
+    SDMX-CSV lists the dimensions in series key order before TIME_PERIOD,
+    only preceded by DATAFLOW (and LAST UPDATE for Eurostat).
+    """
+    if TIME_PERIOD not in header:
+        raise Exception(f'SDMX-CSV header without {TIME_PERIOD}: {header}')
+    time_period_index = header.index(TIME_PERIOD)
+    return [
+        i for i, column in enumerate(header[:time_period_index])
+        if column not in NON_KEY_COLUMNS
+    ]
+
+def _observation_key_indexes(header):
+    """
+    Positions of the series key dimensions and TIME_PERIOD in an SDMX-CSV header
+    """
+    return series_key_indexes(header) + [header.index(TIME_PERIOD)]
+
+def _open_csv(filepath, mode='r'):
+    """
+    Open an SDMX-CSV file for the csv module, `.gz` files are (de)compressed on the fly
+    """
+    if filepath.lower().endswith('.gz'):
+        return gzip.open(filepath, f'{mode}t', newline='', encoding='utf8')
+    return open(filepath, mode, newline='', encoding='utf8')
+
+def merge_delta(base_filepath, delta_filepath, dst_filepath):
+    """
+    Apply the observations of an `updatedAfter` response to a previously downloaded SDMX-CSV file
+
+    Observations are matched by series key and TIME_PERIOD. Changed observations replace
+    their previous row in place, new observations are appended, and observations with
+    ACTION `D` are removed. The delta is expected to be small, it is held in memory
+    while the base file is streamed into `dst_filepath`. Files named `.gz` are gzip compressed.
+
+    :returns: Tuple of the numbers of updated, added and deleted observations.
+    """
+    log = get_configured_logger(LOG_NAME)
+    with _open_csv(delta_filepath) as fin:
+        reader = csv.reader(fin)
+        delta_header = next(reader, None)
+        if delta_header is None:
+            delta_header, delta_rows = [], []
+        else:
+            delta_rows = list(reader)
+    updated = added = deleted = 0
+    with _open_csv(base_filepath) as fin, _open_csv(dst_filepath, 'w') as fout:
+        reader = csv.reader(fin)
+        writer = csv.writer(fout, lineterminator='\n')
+        header = next(reader)
+        writer.writerow(header)
+        key_indexes = _observation_key_indexes(header)
+        changes = dict()
+        if delta_rows:
+            delta_key_indexes = [delta_header.index(header[i]) for i in key_indexes]
+            action_index = delta_header.index(ACTION) if ACTION in delta_header else None
+            # Rows in the column order of the base file, missing columns are left empty
+            positions = [delta_header.index(column) if column in delta_header else None for column in header]
+            for row in delta_rows:
+                key = tuple(row[i] for i in delta_key_indexes)
+                if action_index is not None and ACTION_DELETE == row[action_index]:
+                    changes[key] = None
+                else:
+                    changes[key] = [row[i] if i is not None else '' for i in positions]
+        for row in reader:
+            key = tuple(row[i] for i in key_indexes)
+            if key in changes:
+                new_row = changes.pop(key)
+                if new_row is None:
+                    deleted += 1
+                    continue
+                updated += 1
+                row = new_row
+            writer.writerow(row)
+        for new_row in changes.values():
+            if new_row is not None:
+                added += 1
+                writer.writerow(new_row)
+    log.info('Delta merged into `%s`: %s updated, %s added, %s deleted', dst_filepath, updated, added, deleted)
+    return updated, added, deleted
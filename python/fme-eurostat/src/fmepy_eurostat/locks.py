@@ -0,0 +1,211 @@
+'''
+Advisory file locks that serialize work on the same file across threads and processes.
+
+Several readers of a workspace, or several FME engines on one host, often download the
+same dataflow at the same time. The first one to lock the download does it, the others
+wait for the lock and then find the finished file.
+
+The operating system lock (`fcntl` on POSIX, `msvcrt` on Windows) is released when its
+process ends, a crashed download never leaves a stale lock behind. Within a process the
+lock is combined with a thread lock, since POSIX record locks are owned by the process.
+A lock file may be removed by its holder, whoever obtains the lock on a file that is no
+longer at its path opens the path again.
+'''
+from contextlib import contextmanager
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from fmegeneral.fmelog import get_configured_logger
+
+from .constants import LOG_NAME
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# msvcrt has no blocking lock without a timeout, a locked file is tried again after this many seconds
+POLL_INTERVAL = 0.5
+# Subfolder of the temporary folder for the lock files of `temp_lock_filepath`
+LOCK_FOLDER = 'fme-eurostat-locks'
+
+_lock = threading.Lock()
+_thread_locks = dict()       # [threading.Lock, number of threads holding or waiting for it] by lock file path
+
+def temp_lock_filepath(filepath):
+    """
+    Lock file in the temporary folder for work on `filepath`, so that none is left next to it
+    """
+    key = hashlib.sha256(os.path.normcase(os.path.abspath(filepath)).encode('utf-8')).hexdigest()
+    return os.path.join(tempfile.gettempdir(), LOCK_FOLDER, f'{key}.lock')
+
+def _join(filepath):
+    """
+    Thread lock entry of `filepath`, counting the caller among the threads using it until `_leave`
+    """
+    key = os.path.normcase(os.path.abspath(filepath))
+    with _lock:
+        entry = _thread_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    return key, entry
+
+def _leave(key, entry):
+    with _lock:
+        entry[1] -= 1
+        if not entry[1]:
+            del _thread_locks[key]
+
+@contextmanager
+def _thread_lock(filepath, log, description):
+    """
+    Hold the thread lock of `filepath`, it is dropped once no thread holds or waits for it
+    """
+    key, entry = _join(filepath)
+    thread_lock = entry[0]
+    try:
+        if not thread_lock.acquire(blocking=False):
+            log.info('Waiting for %s in another thread', description)
+            thread_lock.acquire()
+        try:
+            yield
+        finally:
+            thread_lock.release()
+    finally:
+        _leave(key, entry)
+
+def _try_lock(fd):
+    try:
+        if fcntl:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+def _lock_blocking(fd):
+    if fcntl:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        return
+    while not _try_lock(fd):
+        time.sleep(POLL_INTERVAL)
+
+def _unlock(fd):
+    if fcntl:
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+def _is_current(fd, filepath):
+    """
+    `fd` is still the file at `filepath`, the holder of the lock may have removed it meanwhile
+    """
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(fd)
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+def _open_locked(filepath, blocking, log=None, description=None):
+    """
+    Open and lock `filepath`, None if not `blocking` and another process holds the lock
+
+    A lock file that its holder removed while this process waited for it is opened again.
+    """
+    while True:
+        fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if not _try_lock(fd):
+                if not blocking:
+                    os.close(fd)
+                    return None
+                if log is not None:
+                    log.info('Waiting for %s in another process', description)
+                _lock_blocking(fd)
+            if _is_current(fd, filepath):
+                return fd
+            _unlock(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+def _remove(filepath):
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
+def _release(fd, filepath, remove):
+    """
+    Unlock and close `fd`, removing the lock file if `remove`
+    """
+    try:
+        if remove and fcntl:
+            # Removed while locked, processes waiting for the lock notice it and open a new file
+            _remove(filepath)
+        _unlock(fd)
+    finally:
+        os.close(fd)
+    if remove and not fcntl:
+        # Windows refuses to remove a file that another process has open to wait for its lock
+        _remove(filepath)
+
+@contextmanager
+def file_lock(filepath, description=None, remove=False):
+    """
+    Hold an exclusive lock on `filepath`, waiting for other threads and processes that hold it
+
+    The lock file is created if needed.
+
+    :param str description: What the lock protects, logged while waiting for it.
+    :param bool remove: Remove the lock file when the lock is released, for locks
+        on paths that are unlikely to be locked again.
+    """
+    log = get_configured_logger(LOG_NAME)
+    description = description or filepath
+    with _thread_lock(filepath, log, description):
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        fd = _open_locked(filepath, True, log, description)
+        try:
+            yield
+        finally:
+            _release(fd, filepath, remove)
+
+@contextmanager
+def try_file_lock(filepath, remove=False):
+    """
+    Hold the lock on `filepath` only if no other thread or process holds it
+
+    Yields True if the lock is held, False if it is in use.
+
+    :param bool remove: Remove the lock file when the lock is released.
+    """
+    key, entry = _join(filepath)
+    try:
+        if not entry[0].acquire(blocking=False):
+            yield False
+            return
+        try:
+            try:
+                fd = _open_locked(filepath, False)
+            except OSError:
+                fd = None
+            if fd is None:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                _release(fd, filepath, remove)
+        finally:
+            entry[0].release()
+    finally:
+        _leave(key, entry)
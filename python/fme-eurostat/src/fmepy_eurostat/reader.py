@@ -1,8 +1,37 @@
 from pluginbuilder import FMEReader
-from fmeobjects import FMEFeature
+from fmeobjects import FMEFeature, FME_ATTR_STRING
 from fmegeneral.parsers import OpenParameters, parse_def_line
+from fmegeneral.webservices import FMENamedConnectionManager
+from itertools import groupby
 from urllib.parse import (urlparse, parse_qs)
 
+from . import cache, datastructure, download, sessions, where
+from .constants import Agency
+
+# SDMX-CSV columns that are not components of the data structure
+CSV_COLUMNS = ['DATAFLOW', 'LAST UPDATE']
+# Schema types of uncoded SDMX data types, every other column is a string
+STRING_TYPE = 'string'
+SCHEMA_TYPES = {
+      'Double': 'real64'
+    , 'Float': 'real64'
+    , 'Decimal': 'real64'
+    , 'BigInteger': 'int64'
+    , 'Integer': 'int64'
+    , 'Long': 'int64'
+    , 'Short': 'int32'
+    , 'Count': 'int64'
+}
+CONVERTERS = {'real64': float, 'int64': int, 'int32': int}
+# OUTPUT_MODE: one feature per observation, or one feature per series with its observations
+# in the list `observations{}` or in attributes named after their TIME_PERIOD
+OUTPUT_OBSERVATIONS = 'OBSERVATIONS'
+OUTPUT_SERIES_LIST = 'SERIES_LIST'
+OUTPUT_SERIES_PERIODS = 'SERIES_PERIODS'
+OUTPUT_MODES = [OUTPUT_OBSERVATIONS, OUTPUT_SERIES_LIST, OUTPUT_SERIES_PERIODS]
+OBSERVATIONS_LIST = 'observations'
+PRIMARY_MEASURE = 'OBS_VALUE'
+
 class EurostatReader(FMEReader):
     def __init__(self, mapping_file, log):
         self._log = log
@@ -23,14 +52,26 @@ class EurostatReader(FMEReader):
         self._schema_iterator = None
         self._feature_iterator = None
         self._mapping_file = mapping_file
+        self._mapping_file_parameters = dict()
+        self._output_mode = OUTPUT_OBSERVATIONS
+        self._agency = None
+        self._cache_folder = None
+        self._cache_timeout = cache.parse_timeout(None)
+        self._structures = dict()   # DataStructure by feature type
+        self._schemas = dict()      # list of (attribute, type) by feature type
+        self._where_clauses = dict()
+        self._projections = dict()     # upper case attributes defined for a feature type, read when fme_attribute_reading is `defined`
 
         self._feature_types = set()
 
         
     def abort(self):
-        pass
+        self.close()
     def close(self):
-        pass
+        # Closing the generator closes the response it is streaming
+        if self._feature_iterator is not None:
+            self._feature_iterator.close()
+            self._feature_iterator = None
     def getProperties(self, propertyCategory):
         self._log.debug('getProperties %s', propertyCategory)
         return {
@@ -48,8 +89,14 @@ class EurostatReader(FMEReader):
         self._log.info(' parameters: %s', parameters)
         parsed_parameters = OpenParameters(datasetName, parameters)
         self._log.info(' parsed_parameters: %s', parsed_parameters)
-        mapping_file_parameters = {k: self._mapping_file.get(k) for k in ['CONNECTION', 'START_PERIOD', 'END_PERIOD', 'FIRST_N_OBSERVATIONS', 'LAST_N_OBSERVATIONS']}
+        mapping_file_parameters = {k: self._mapping_file.get(k) for k in ['CONNECTION', 'START_PERIOD', 'END_PERIOD', 'FIRST_N_OBSERVATIONS', 'LAST_N_OBSERVATIONS', 'OUTPUT_MODE']}
         self._log.info(' mapping_file_parameters: %s', mapping_file_parameters)
+        self._mapping_file_parameters = mapping_file_parameters
+        output_mode = (mapping_file_parameters.get('OUTPUT_MODE') or OUTPUT_OBSERVATIONS).upper()
+        if output_mode not in OUTPUT_MODES:
+            self._log.warn('Unknown OUTPUT_MODE %s (expected one of %s), reading one feature per observation', output_mode, ', '.join(OUTPUT_MODES))
+            output_mode = OUTPUT_OBSERVATIONS
+        self._output_mode = output_mode
         ids = parsed_parameters.get('+ID')
         if str == type(ids):
             ids = [ids]
@@ -69,29 +116,287 @@ class EurostatReader(FMEReader):
             feature_type, attributes, options = parse_def_line(defline, ['fme_attribute_reading', 'eurostat_where_clause'])
             self._log.info(' %s %s %s', feature_type, attributes, options)
             self._feature_types.add(feature_type)
-    def read(self):
-        if self._feature_iterator is None:
-            self._feature_iterator = iter([
-                (ft, [('asdf', 'Hello World!'),('bsdf', 42)])
-                for ft in self._feature_types
-            ])
-        record = next(self._feature_iterator, None)
-        if record:
-            feature_type, attributes = record    
+            if options.get('eurostat_where_clause'):
+                self._where_clauses[feature_type] = options['eurostat_where_clause']
+            if 'defined' == (options.get('fme_attribute_reading') or '').lower():
+                # Upper case, attributes exposed from an older schema may have the SDMX-CSV names
+                self._projections[feature_type] = {attribute.upper() for attribute in attributes}
+    def _connect(self):
+        """
+        Use the agency and the cache of the named connection, its settings also apply to the requests of the reader
+        """
+        if self._agency is not None:
+            return
+        self._agency = Agency.ESTAT
+        nc_name = self._mapping_file_parameters.get('CONNECTION')
+        if not nc_name:
+            return
+        nc = FMENamedConnectionManager().getNamedConnection(nc_name)
+        if nc is None:
+            self._log.warn('Named Connection %s not found', nc_name)
+            return
+        nc_params = nc.getKeyValues()
+        self._agency = Agency[nc_params['AGENCY']]
+        self._cache_folder = nc_params.get('CACHE_FOLDER') or None
+        self._cache_timeout = cache.parse_timeout(nc_params.get('CACHE_TIMEOUT'))
+        sessions.configure_connection(self._agency, nc_params)
+
+    def _structure(self, feature_type):
+        """
+        Data structure definition of the dataflow of a feature type
+        """
+        if feature_type not in self._structures:
+            self._connect()
+            self._structures[feature_type] = datastructure.get(
+                  self._agency
+                , feature_type
+                , cache_folder=self._cache_folder
+                , cache_timeout=self._cache_timeout
+            )
+        return self._structures[feature_type]
+
+    def _schema(self, feature_type):
+        """
+        Attributes of a feature type and their types, derived from the data structure definition of the dataflow
+
+        :returns: List of (attribute, type) tuples in SDMX-CSV column order.
+        """
+        if feature_type not in self._schemas:
+            self._schemas[feature_type] = [(column, STRING_TYPE) for column in CSV_COLUMNS] + [
+                (component_id, SCHEMA_TYPES.get(text_type, STRING_TYPE))
+                for component_id, text_type in self._structure(feature_type).columns()
+            ]
+        return self._schemas[feature_type]
+
+    def _output_schema(self, feature_type):
+        """
+        Schema of the features of the output mode: series features have the series attributes
+        and the observations as list, the attributes named after time periods are not known in advance
+        """
+        schema = self._schema(feature_type)
+        if OUTPUT_OBSERVATIONS == self._output_mode:
+            return schema
+        series_columns = {'DATAFLOW'} | {dimension.id for dimension in self._structure(feature_type).dimensions}
+        series_schema = [(column, schema_type) for column, schema_type in schema if column in series_columns]
+        if OUTPUT_SERIES_LIST == self._output_mode:
+            series_schema += [
+                (f'{OBSERVATIONS_LIST}{{}}.{column}', schema_type)
+                for column, schema_type in schema if column not in series_columns
+            ]
+        return series_schema
+
+    def _query(self, feature_type):
+        """
+        Url and parameters of the data query of a feature type, with as much of its where clause as the server can apply
+
+        :returns: Tuple of the url, the query parameters and the residual predicate
+            to apply to the rows, None if there is nothing left to apply.
+            The url is None if the clause cannot match any observation.
+        """
+        url = download.data_url(self._agency, feature_type)
+        params = download.data_params(self._mapping_file_parameters)
+        clause = self._where_clauses.get(feature_type)
+        if not clause:
+            return url, params, None
+        try:
+            structure = self._structure(feature_type)
+        except Exception as e:
+            self._log.warn('Data structure of %s not available (%s), filtering all rows', feature_type, e)
+            structure = None
+        def find_dimension(column):
+            dimension = structure.find_dimension(column) if structure else None
+            return dimension.id if dimension else None
+        pushdown = where.compile_where(
+              clause
+            , find_dimension
+            , periods='firstNObservations' not in params and 'lastNObservations' not in params
+        )
+        if pushdown.empty:
+            return None, params, None
+        if pushdown.key_filter:
+            url = f'{url}/{structure.make_key(pushdown.key_filter)}'
+        if pushdown.start_period:
+            params['startPeriod'] = max(params.get('startPeriod', pushdown.start_period), pushdown.start_period)
+        if pushdown.end_period:
+            params['endPeriod'] = min(params.get('endPeriod', pushdown.end_period), pushdown.end_period)
+        self._log.info('Where clause of %s: key %s, period %s to %s, %s', feature_type, pushdown.key_filter
+            , params.get('startPeriod'), params.get('endPeriod'), 'rows filtered' if pushdown.residual else 'nothing left to filter')
+        return url, params, pushdown.residual
+
+    def _column_indexes(self, feature_type, names):
+        """
+        Positions of the columns to turn into attributes, None if all columns are read
+
+        :param names: Attribute names of the columns.
+        """
+        projection = self._projections.get(feature_type)
+        if projection is None:
+            return None
+        indexes = [i for i, name in enumerate(names) if name.upper() in projection]
+        self._log.info('Reading %s of %s columns of %s', len(indexes), len(names), feature_type)
+        return indexes
+
+    def _column_names(self, feature_type, header):
+        """
+        Attribute names of the columns of `header`, as in the schema
+
+        SDMX-CSV writes dimension ids in lower case (`geo`), the schema has the ids
+        of the data structure definition (`GEO`). Columns that are not in the schema keep their name.
+        """
+        try:
+            schema = self._schema(feature_type)
+        except Exception:
+            # Logged by _converters
+            return list(header)
+        names = {name.upper(): name for name, _ in schema}
+        return [names.get(column.upper(), column) for column in header]
+
+    def _converters(self, feature_type, names):
+        """
+        Value conversion of every column, None for string columns
+
+        :param names: Attribute names of the columns.
+        """
+        try:
+            types = dict(self._schema(feature_type))
+        except Exception as e:
+            self._log.warn('Data structure of %s not available (%s), reading all values as strings', feature_type, e)
+            types = dict()
+        return [CONVERTERS.get(types.get(name)) for name in names]
+
+    def _iter_features(self):
+        """
+        Stream the data of every feature type from the server and turn its rows into features
+
+        The gzip response is inflated, split into lines and rows and turned into features
+        while it is received, only the chunk being decoded is held in memory.
+        """
+        self._connect()
+        for feature_type in sorted(ft for ft in self._feature_types if ft):
+            url, params, residual = self._query(feature_type)
+            if url is None:
+                self._log.info('Where clause of %s cannot match any observation', feature_type)
+                continue
+            self._log.info('Reading %s %s', url, params)
+            rows = download.iter_csv_rows(url, params)
+            header = next(rows, None)
+            if header is None:
+                self._log.info('No data for %s', feature_type)
+                continue
+            if residual is not None:
+                # Applied to whole rows, the clause may use columns that are not read
+                rows = filter(where.make_filter(residual, header), rows)
+            if OUTPUT_OBSERVATIONS == self._output_mode:
+                features = self._observation_features(feature_type, header, rows)
+            else:
+                features = self._series_features(feature_type, header, rows)
+            count = 0
+            for feature in features:
+                count += 1
+                yield feature
+            self._log.info('%s features read from %s', count, feature_type)
+
+    def _observation_features(self, feature_type, header, rows):
+        """
+        One feature per row
+        """
+        names = self._column_names(feature_type, header)
+        columns = list(zip(names, self._converters(feature_type, names)))
+        indexes = self._column_indexes(feature_type, names)
+        if indexes is not None:
+            # Unexposed columns are neither converted nor set
+            columns = [columns[i] for i in indexes]
+            rows = ([row[i] for i in indexes] for row in rows)
+        for row in rows:
             feature = FMEFeature()
             feature.setFeatureType(feature_type)
-            for n,t in attributes:
-                feature.setAttribute(n, t)
-            return feature
-        return None
+            for (name, convert), value in zip(columns, row):
+                if not value:
+                    feature.setAttributeNullWithType(name, FME_ATTR_STRING)
+                    continue
+                if convert is not None:
+                    try:
+                        value = convert(value)
+                    except ValueError:
+                        pass
+                feature.setAttribute(name, value)
+            yield feature
+
+    def _series_features(self, feature_type, header, rows):
+        """
+        One feature per series, with the values of its dimensions and a list entry
+        (or attributes named after the time period) for each of its observations
+
+        The rows are grouped in a single pass, as SDMX-CSV lists the observations of a series
+        one after the other. A series whose rows are not consecutive yields several features.
+        """
+        key_indexes = download.series_key_indexes(header)
+        series_indexes = [i for i, column in enumerate(header) if 'DATAFLOW' == column or i in key_indexes]
+        time_index = header.index(download.TIME_PERIOD)
+        names = self._column_names(feature_type, header)
+        converters = self._converters(feature_type, names)
+        projection = self._projections.get(feature_type)
+        series_columns = [
+            (i, names[i], converters[i])
+            for i in series_indexes
+            if projection is None or names[i].upper() in projection
+        ]
+        if OUTPUT_SERIES_PERIODS == self._output_mode:
+            # The attribute names depend on the data, all of them are read
+            observation_columns = [
+                (i, names[i], converters[i])
+                for i in range(len(header))
+                if i not in series_indexes and i != time_index
+            ]
+        else:
+            observation_columns = [
+                (i, names[i], converters[i])
+                for i in range(len(header))
+                if i not in series_indexes and (
+                    projection is None or f'{OBSERVATIONS_LIST}{{}}.{names[i]}'.upper() in projection
+                )
+            ]
+        for _, series_rows in groupby(rows, key=lambda row: [row[i] for i in key_indexes]):
+            feature = FMEFeature()
+            feature.setFeatureType(feature_type)
+            for j, row in enumerate(series_rows):
+                if 0 == j:
+                    for i, name, convert in series_columns:
+                        self._set_value(feature, name, row[i], convert)
+                for i, name, convert in observation_columns:
+                    if OUTPUT_SERIES_LIST == self._output_mode:
+                        name = f'{OBSERVATIONS_LIST}{{{j}}}.{name}'
+                    elif PRIMARY_MEASURE == name:
+                        name = row[time_index]
+                    else:
+                        name = f'{row[time_index]}_{name}'
+                    self._set_value(feature, name, row[i], convert)
+            yield feature
+
+    def _set_value(self, feature, name, value, convert):
+        if not value:
+            feature.setAttributeNullWithType(name, FME_ATTR_STRING)
+            return
+        if convert is not None:
+            try:
+                value = convert(value)
+            except ValueError:
+                pass
+        feature.setAttribute(name, value)
+
+    def read(self):
+        if self._feature_iterator is None:
+            self._feature_iterator = self._iter_features()
+        return next(self._feature_iterator, None)
 
 
     def readSchema(self):
+        # One small structure request per dataflow instead of scanning its data for types
         if self._schema_iterator is None:
-            self._schema_iterator = iter([
-                (ft, [('asdf', 'str'),('bsdf', 'int')])
-                for ft in self._feature_types
-            ])
+            self._schema_iterator = (
+                (ft, self._output_schema(ft))
+                for ft in sorted(ft for ft in self._feature_types if ft)
+            )
         schema_record = next(self._schema_iterator, None)
         self._log.info('schema record: %s', schema_record)
         if schema_record:
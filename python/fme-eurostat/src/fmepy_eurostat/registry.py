@@ -0,0 +1,110 @@
+'''
+Process-wide registry of loaded catalogs.
+
+`makeInstance` creates a new EurostatFilesystem for every parameter change and FME Flow
+engines run many translations in one process. The registry lets all of those instances
+share one parsed catalog per key instead of reading it again.
+'''
+from collections import OrderedDict
+import threading
+import time
+
+from fmegeneral.fmelog import get_configured_logger
+
+from .constants import LOG_NAME, DEFAULT_CACHE_TIMEOUT
+
+class _Entry:
+    __slots__ = ('catalog', 'error', 'loaded_at', 'done')
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.error = None
+        self.loaded_at = None
+        self.done = threading.Event()
+
+class CatalogRegistry:
+    def __init__(self, catalog_factory, max_entries=8, max_age=DEFAULT_CACHE_TIMEOUT):
+        """
+        :param catalog_factory: Creates the empty catalog that a load populates.
+        :param int max_entries: Least recently used catalogs are evicted beyond this number.
+        :param float max_age: Default age in seconds after which a catalog is loaded again.
+        """
+        self._catalog_factory = catalog_factory
+        self._max_entries = max_entries
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, load, max_age=None, roots_only=False):
+        """
+        Return the catalog registered under `key`, loading it first if needed
+
+        Only one caller loads a missing or expired catalog (single flight), concurrent callers
+        for the same key wait for that load and share its result or its error.
+
+        :param key: Hashable catalog identity.
+        :param load: Called as `load(catalog)` with an empty catalog, it returns the loaded catalog
+            which may be the one given or another instance, e.g. from the disk cache.
+        :param float max_age: Overrides the default age limit of the registry.
+        :param bool roots_only: Return as soon as the roots of the catalog are known,
+            the catalog may still be incomplete then (see `Catalog.ready`).
+        """
+        max_age = self._max_age if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.done.is_set() \
+                    and (entry.error is not None or time.monotonic() - entry.loaded_at > max_age):
+                del self._entries[key]
+                entry = None
+            owner = entry is None
+            if owner:
+                entry = _Entry(self._catalog_factory())
+                self._entries[key] = entry
+                self._evict()
+            else:
+                self._entries.move_to_end(key)
+
+        if owner:
+            if roots_only:
+                # Answer from the partially read catalog while the load continues in the background
+                threading.Thread(target=self._load, args=(key, entry, load), daemon=True).start()
+            else:
+                self._load(key, entry, load)
+
+        if roots_only and not entry.done.is_set():
+            catalog = entry.catalog
+            catalog.roots_ready.wait()
+            if not entry.done.is_set() and catalog.roots:
+                return catalog
+        entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+        return entry.catalog
+
+    def _load(self, key, entry, load):
+        log = get_configured_logger(LOG_NAME)
+        placeholder = entry.catalog
+        log.info('Loading catalog %s', key)
+        try:
+            entry.catalog = load(placeholder)
+            entry.loaded_at = time.monotonic()
+        except BaseException as e:
+            log.error('Loading catalog %s failed: %s', key, e)
+            entry.error = e
+        finally:
+            entry.done.set()
+            # Release callers waiting on the placeholder, whatever the outcome of the load
+            placeholder.roots_ready.set()
+            placeholder.ready.set()
+
+    def _evict(self):
+        while len(self._entries) > self._max_entries:
+            key, entry = next(iter(self._entries.items()))
+            if not entry.done.is_set():
+                # Never evict a catalog that is still loading
+                break
+            get_configured_logger(LOG_NAME).info('Evicting catalog %s', key)
+            del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,354 @@
+'''
+Streaming parsers for SDMX-ML 2.1 structure messages.
+
+The documents are consumed incrementally with `iterparse`. Every element is
+detached from its parent as soon as it has been interpreted, so memory use
+depends on the nesting depth of the document and not on its size.
+'''
+from contextlib import contextmanager
+from dataclasses import dataclass
+import xml.etree.ElementTree as ET
+
+NS_COMMON = 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/common'
+NS_STRUCTURE = 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+DISSEMINATION_PERSPECTIVE_ID = 'DISSEMINATION_PERSPECTIVE_ID'
+REQUEST_TIMEOUT = 300
+
+@dataclass
+class CategorySchemeRecord:
+    id: str
+    name: str
+    xml_id: str
+
+@dataclass
+class CategoryRecord:
+    id: str
+    name: str
+    urn: str
+    xml_id: str
+    xml_parent_id: str
+
+@dataclass
+class CategorisationRecord:
+    category_urn: str
+    dataflow_id: str
+
+@dataclass
+class DataflowRecord:
+    id: str
+    name: str
+
+@dataclass
+class CodelistRecord:
+    agency_id: str
+    id: str
+    is_final: str
+    urn: str
+    version: str
+    name: str
+
+@dataclass
+class CodeRecord:
+    codelist_id: str
+    id: str
+    name: str
+
+@dataclass
+class DimensionRecord:
+    id: str
+    position: int
+    codelist_id: str
+
+@dataclass
+class ComponentRecord:
+    id: str
+    kind: str           # TimeDimension, Attribute or PrimaryMeasure
+    codelist_id: str
+    text_type: str      # SDMX data type of an uncoded component, e.g. `Double`
+
+class _OpenElement:
+    '''
+    Values collected for an element whose end tag has not been seen yet
+    '''
+    __slots__ = ('id', 'urn', 'name', 'xml_id', 'xml_parent_id', 'perspective', 'source_id', 'target_urn')
+    def __init__(self, id=None, urn=None, xml_id=None, xml_parent_id=None):
+        self.id = id
+        self.urn = urn
+        self.name = None
+        self.xml_id = xml_id
+        self.xml_parent_id = xml_parent_id
+        self.perspective = None
+        self.source_id = None
+        self.target_urn = None
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+def make_ref_urn(ref):
+    '''
+    Same urn as composed by xfmap/data_discovery.xmp for Categorisation/Target/Ref
+    '''
+    return 'urn:sdmx:org.sdmx.infomodel.{}.{}={}:{}({}).{}'.format(
+          ref.get('package')
+        , ref.get('class')
+        , ref.get('agencyID')
+        , ref.get('maintainableParentID')
+        , ref.get('maintainableParentVersion')
+        , ref.get('id')
+    )
+
+def parse_catalog_structures(fin, lang='en'):
+    """
+    Read category schemes, categorisations and dataflows from an SDMX-ML structure message
+
+    Category schemes and categorisations annotated with DISSEMINATION_PERSPECTIVE_ID `T`
+    are skipped, as are the categories of such schemes.
+
+    :param fin: Binary file-like object with the structure message.
+    :param str lang: Language of the names to extract.
+    :returns: Generator of CategorySchemeRecord, CategoryRecord, CategorisationRecord and DataflowRecord,
+        every record is yielded when the end tag of its element has been parsed.
+    """
+    elements = []    # open elements, the document root first
+    names = []       # local names of the open elements
+    containers = []  # open CategoryScheme and Category elements
+    current = None   # open Categorisation or Dataflow element
+    annotation = dict()
+    sequence = 0
+    for event, elem in ET.iterparse(fin, events=('start', 'end')):
+        if 'start' == event:
+            name = local_name(elem.tag)
+            elements.append(elem)
+            names.append(name)
+            if 'CategoryScheme' == name or 'Category' == name:
+                sequence += 1
+                parent = containers[-1] if containers else None
+                containers.append(_OpenElement(
+                      elem.get('id')
+                    , elem.get('urn')
+                    , f'id-{name}-{sequence}'
+                    , parent.xml_id if parent else None
+                ))
+            elif 'Categorisation' == name or 'Dataflow' == name:
+                current = _OpenElement(elem.get('id'), elem.get('urn'))
+            continue
+
+        name = names.pop()
+        elements.pop()
+        parent_name = names[-1] if names else None
+        if 'Name' == name:
+            if lang == elem.get(XML_LANG):
+                if 'Categorisation' == parent_name or 'Dataflow' == parent_name:
+                    current.name = elem.text
+                elif 'CategoryScheme' == parent_name or 'Category' == parent_name:
+                    containers[-1].name = elem.text
+        elif 'AnnotationType' == name or 'AnnotationTitle' == name:
+            annotation[name] = elem.text
+        elif 'Annotation' == name:
+            owner_name = names[-2] if len(names) > 1 else None
+            if DISSEMINATION_PERSPECTIVE_ID == annotation.get('AnnotationType'):
+                if 'CategoryScheme' == owner_name:
+                    containers[-1].perspective = annotation.get('AnnotationTitle')
+                elif 'Categorisation' == owner_name:
+                    current.perspective = annotation.get('AnnotationTitle')
+            annotation.clear()
+        elif 'Ref' == name and len(names) > 1 and 'Categorisation' == names[-2]:
+            if 'Source' == parent_name:
+                current.source_id = elem.get('id')
+            elif 'Target' == parent_name:
+                current.target_urn = make_ref_urn(elem)
+        elif 'Category' == name:
+            category = containers.pop()
+            if not 'T' == containers[0].perspective:
+                yield CategoryRecord(category.id, category.name, category.urn, category.xml_id, category.xml_parent_id)
+        elif 'CategoryScheme' == name:
+            category_scheme = containers.pop()
+            if not 'T' == category_scheme.perspective:
+                yield CategorySchemeRecord(category_scheme.id, category_scheme.name, category_scheme.xml_id)
+        elif 'Categorisation' == name:
+            if not 'T' == current.perspective:
+                yield CategorisationRecord(current.target_urn, current.source_id)
+            current = None
+        elif 'Dataflow' == name:
+            yield DataflowRecord(current.id, current.name)
+            current = None
+        # Everything needed from this element has been collected
+        if elements:
+            elements[-1].remove(elem)
+
+class NotModified(Exception):
+    """
+    The server answered a conditional request with 304 Not Modified
+    """
+
+def conditional_headers(validators):
+    """
+    Request headers that revalidate a document against the validators of a cached copy
+    """
+    headers = dict()
+    if validators:
+        if validators.get('ETag'):
+            headers['If-None-Match'] = validators['ETag']
+        if validators.get('Last-Modified'):
+            headers['If-Modified-Since'] = validators['Last-Modified']
+    return headers
+
+def parse_codelists(fin, lang='en'):
+    """
+    Read codelists from an SDMX-ML structure message
+
+    :param fin: Binary file-like object with the structure message.
+    :param str lang: Language of the names to extract.
+    :returns: Generator of CodeRecord for every code, followed by a CodelistRecord
+        when the end of the codelist has been parsed.
+    """
+    elements = []
+    names = []
+    codelist = None
+    code = None
+    for event, elem in ET.iterparse(fin, events=('start', 'end')):
+        if 'start' == event:
+            name = local_name(elem.tag)
+            elements.append(elem)
+            names.append(name)
+            if 'Codelist' == name:
+                codelist = CodelistRecord(
+                      elem.get('agencyID')
+                    , elem.get('id')
+                    , elem.get('isFinal')
+                    , elem.get('urn')
+                    , elem.get('version')
+                    , None
+                )
+            elif 'Code' == name and codelist is not None:
+                code = CodeRecord(codelist.id, elem.get('id'), None)
+            continue
+
+        name = names.pop()
+        elements.pop()
+        parent_name = names[-1] if names else None
+        if 'Name' == name and lang == elem.get(XML_LANG):
+            if 'Code' == parent_name and code is not None:
+                code.name = elem.text
+            elif 'Codelist' == parent_name:
+                codelist.name = elem.text
+        elif 'Code' == name and code is not None:
+            yield code
+            code = None
+        elif 'Codelist' == name:
+            yield codelist
+            codelist = None
+        if elements:
+            elements[-1].remove(elem)
+
+# Components of a data structure by the list they are declared in, the same
+# names occur as references within AttributeRelationship
+COMPONENT_LISTS = {
+      'Dimension': 'DimensionList'
+    , 'TimeDimension': 'DimensionList'
+    , 'Attribute': 'AttributeList'
+    , 'PrimaryMeasure': 'MeasureList'
+}
+
+def parse_data_structure(fin, lang='en'):
+    """
+    Read the components and the codelists of a dataflow from an SDMX-ML structure message
+
+    The message is expected to contain the data structure definition and its codelists,
+    e.g. the response to `dataflow/{agency}/{flow}?references=descendants`.
+
+    :param fin: Binary file-like object with the structure message.
+    :param str lang: Language of the names to extract.
+    :returns: Generator of DimensionRecord for the dimensions of the series key,
+        ComponentRecord for the time dimension, the attributes and the primary measure,
+        CodeRecord and CodelistRecord as in `parse_codelists`.
+    """
+    elements = []
+    names = []
+    dimension = None
+    component = None
+    codelist = None
+    code = None
+    for event, elem in ET.iterparse(fin, events=('start', 'end')):
+        if 'start' == event:
+            name = local_name(elem.tag)
+            elements.append(elem)
+            names.append(name)
+            parent_name = names[-2] if len(names) > 1 else None
+            if name in COMPONENT_LISTS and COMPONENT_LISTS[name] == parent_name:
+                if 'Dimension' == name:
+                    dimension = DimensionRecord(elem.get('id'), int(elem.get('position') or 0), None)
+                else:
+                    component = ComponentRecord(elem.get('id'), name, None, None)
+            elif 'Codelist' == name:
+                codelist = CodelistRecord(
+                      elem.get('agencyID')
+                    , elem.get('id')
+                    , elem.get('isFinal')
+                    , elem.get('urn')
+                    , elem.get('version')
+                    , None
+                )
+            elif 'Code' == name and codelist is not None:
+                code = CodeRecord(codelist.id, elem.get('id'), None)
+            continue
+
+        name = names.pop()
+        elements.pop()
+        parent_name = names[-1] if names else None
+        if 'Ref' == name and 'Enumeration' == parent_name:
+            if dimension is not None:
+                dimension.codelist_id = elem.get('id')
+            elif component is not None:
+                component.codelist_id = elem.get('id')
+        elif 'TextFormat' == name and component is not None:
+            component.text_type = elem.get('textType')
+        elif 'Dimension' == name and dimension is not None and 'DimensionList' == parent_name:
+            yield dimension
+            dimension = None
+        elif name in COMPONENT_LISTS and component is not None and COMPONENT_LISTS[name] == parent_name:
+            yield component
+            component = None
+        elif 'Name' == name and lang == elem.get(XML_LANG):
+            if 'Code' == parent_name and code is not None:
+                code.name = elem.text
+            elif 'Codelist' == parent_name:
+                codelist.name = elem.text
+        elif 'Code' == name and code is not None:
+            yield code
+            code = None
+        elif 'Codelist' == name:
+            yield codelist
+            codelist = None
+        if elements:
+            elements[-1].remove(elem)
+
+@contextmanager
+def open_structure(dataset, validators=None):
+    """
+    Open a structure message for binary reading, either from an url or a local file
+
+    :param dict validators: `ETag` and `Last-Modified` of a cached copy of the document,
+        makes the request conditional. NotModified is raised if the copy is still current.
+    :returns: Context manager for a tuple of the binary stream and the validators
+        of the response (None for local files).
+    """
+    if not dataset.startswith(('http://', 'https://')):
+        with open(dataset, 'rb') as f:
+            yield f, None
+        return
+    from . import sessions
+    headers = conditional_headers(validators)
+    with sessions.get(dataset, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as r:
+        if 304 == r.status_code:
+            raise NotModified(dataset)
+        r.raise_for_status()
+        response_validators = {
+            k: r.headers[k]
+            for k in ['ETag', 'Last-Modified']
+            if k in r.headers
+        }
+        # Let urllib3 inflate gzip/deflate transfer encodings while streaming
+        r.raw.decode_content = True
+        yield r.raw, response_validators
@@ -0,0 +1,100 @@
+'''
+Inverted index used by the `WEB_SELECT` search of the Eurostat filesystem.
+
+Names are tokenized, case-folded and accent-folded once per catalog load.
+Every query term is matched as a prefix against the sorted token list, a query
+with several terms only returns items that match all of them.
+'''
+from bisect import bisect_left
+from collections import defaultdict
+import re
+import unicodedata
+
+TOKEN_PATTERN = re.compile(r'\w+')
+SCORE_EXACT = 3
+SCORE_PREFIX = 1
+
+def fold(text):
+    """
+    Case-fold and strip accents: `Émissions` -> `emissions`
+    """
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+def tokenize(text):
+    """
+    Split a name into index tokens
+
+    Dataflow codes are kept whole and are also indexed by their parts and underscore suffixes,
+    so `NAMA_10_GDP` is found by `nama_10`, `10_gdp` and `gdp`.
+    """
+    tokens = set()
+    for token in TOKEN_PATTERN.findall(fold(text)):
+        tokens.add(token)
+        parts = [part for part in token.split('_') if part]
+        if len(parts) > 1:
+            tokens.update(parts)
+            tokens.update('_'.join(parts[i:]) for i in range(1, len(parts)))
+    return tokens
+
+class SearchIndex:
+    def __init__(self, items):
+        """
+        :param items: Objects with a `name`, the order is kept for equally ranked results.
+        """
+        self._items = list(items)
+        postings = defaultdict(list)
+        for i, item in enumerate(self._items):
+            for token in tokenize(item.name):
+                postings[token].append(i)
+        self._postings = dict(postings)
+        self._tokens = sorted(self._postings)
+        # Among equally scored items shorter names rank first
+        by_length = sorted(range(len(self._items)), key=lambda i: len(self._items[i].name))
+        self._tie_break = [0] * len(self._items)
+        for position, i in enumerate(by_length):
+            self._tie_break[i] = position
+
+    def __len__(self):
+        return len(self._items)
+
+    def _match(self, term):
+        """
+        Best score per item for a single query term
+        """
+        scores = dict()
+        tokens = self._tokens
+        # Walk from the first candidate instead of copying the rest of the token list
+        for position in range(bisect_left(tokens, term), len(tokens)):
+            token = tokens[position]
+            if not token.startswith(term):
+                break
+            score = SCORE_EXACT if token == term else SCORE_PREFIX
+            for i in self._postings[token]:
+                if scores.get(i, 0) < score:
+                    scores[i] = score
+        return scores
+
+    def search(self, query):
+        """
+        Items matching every term of `query`, best matches first
+
+        :param str query: Free text as entered in the search field, every item is returned
+            in catalog order if it has no terms (empty, whitespace or punctuation only).
+        :rtype: list
+        """
+        terms = TOKEN_PATTERN.findall(fold(query))
+        if not terms:
+            return list(self._items)
+        scores = None
+        # Rarest terms first keeps the intermediate result small
+        for term_scores in sorted((self._match(term) for term in set(terms)), key=len):
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {i: score + term_scores[i] for i, score in scores.items() if i in term_scores}
+            if not scores:
+                return []
+        tie_break = self._tie_break
+        ranked = sorted(scores, key=lambda i: (-scores[i], tie_break[i]))
+        return [self._items[i] for i in ranked]
@@ -0,0 +1,181 @@
+'''
+Pooled HTTP sessions shared by all requests of the process.
+
+There is one `requests.Session` per scheme and host, so the structure messages,
+codelists and data of a translation reuse the same keep-alive connections
+instead of paying DNS, TCP and TLS setup for every request.
+
+The named connection of an agency sets the pool size, proxy and rate limit of its requests.
+The agencies COMP, EMPL and GROW share a host, so the settings apply to the base uri of
+the agency rather than the host. Agencies with the same pool size share the sessions of a host.
+'''
+from email.utils import parsedate_to_datetime
+import threading
+import time
+from urllib.parse import urlparse
+
+from fmegeneral.fmelog import get_configured_logger
+
+from .constants import LOG_NAME
+
+DEFAULT_POOL_SIZE = 10
+
+_lock = threading.Lock()
+_sessions = dict()           # requests.Session by (host, pool size)
+_rate_limiters = dict()      # RateLimiter by base uri
+_settings = dict()           # settings of `configure` by base uri
+_clock_offsets = dict()      # seconds the clock of the host is ahead of the local clock, by host
+DEFAULT_SETTINGS = {
+      'pool_size': DEFAULT_POOL_SIZE
+    , 'proxies': None
+}
+
+def configure(base_uri, pool_size=None, proxy=None):
+    """
+    Settings of the requests to urls starting with `base_uri`, replacing those of a previous call
+
+    Settings that are not given are the defaults, not kept from a previous call.
+
+    :param int pool_size: Maximum number of connections kept open per host,
+        at least the number of concurrent requests.
+    :param str proxy: Proxy url for http and https, overrides the environment (HTTPS_PROXY, ...)
+        which is used if not given.
+    """
+    with _lock:
+        _settings[base_uri] = {
+              'pool_size': int(pool_size) if pool_size else DEFAULT_POOL_SIZE
+            , 'proxies': {'http': proxy, 'https': proxy} if proxy else None
+        }
+
+def _find(values, url):
+    """
+    Value of the longest base uri in `values` that `url` starts with, None if there is none
+    """
+    base_uris = [base_uri for base_uri in values if url.startswith(base_uri)]
+    return values[max(base_uris, key=len)] if base_uris else None
+
+def _url_settings(url):
+    with _lock:
+        return _find(_settings, url) or DEFAULT_SETTINGS
+
+class RateLimiter:
+    '''
+    Spaces out the requests of all threads to at most `rate` per second
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self._interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def set_rate_limit(base_uri, rate):
+    """
+    Limit the requests to urls starting with `base_uri` to `rate` per second, no limit if `rate` is empty
+    """
+    with _lock:
+        if not rate or float(rate) <= 0:
+            _rate_limiters.pop(base_uri, None)
+        elif base_uri not in _rate_limiters or _rate_limiters[base_uri].rate != float(rate):
+            _rate_limiters[base_uri] = RateLimiter(float(rate))
+
+def configure_connection(agency, nc_params):
+    """
+    Apply the settings of a named connection (Connections per Host, Proxy URL, Requests per Second) for `agency`
+    """
+    configure(agency.base_uri, pool_size=nc_params.get('POOL_SIZE'), proxy=nc_params.get('PROXY'))
+    set_rate_limit(agency.base_uri, nc_params.get('RATE_LIMIT'))
+
+def _rate_limiter(url):
+    with _lock:
+        return _find(_rate_limiters, url)
+
+def _host(url):
+    parts = urlparse(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+def get_session(url):
+    """
+    Session for the host of `url` with the pool size configured for it, created on first use
+
+    :rtype: requests.Session
+    """
+    import requests
+    host = _host(url)
+    pool_size = _url_settings(url)['pool_size']
+    with _lock:
+        session = _sessions.get((host, pool_size))
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount(f'{host}/', adapter)
+            _sessions[(host, pool_size)] = session
+    return session
+
+def get(url, **kwargs):
+    """
+    `requests.get` through the shared session of the host, waiting for the rate limit of the agency
+    """
+    limiter = _rate_limiter(url)
+    if limiter is not None:
+        limiter.acquire()
+    proxies = _url_settings(url)['proxies']
+    if proxies:
+        # Unlike the proxies of the session, the proxies of a request take precedence over the environment
+        kwargs.setdefault('proxies', dict(proxies))
+    r = get_session(url).get(url, **kwargs)
+    _record_clock(url, r)
+    return r
+
+def _record_clock(url, r):
+    """
+    Offset of the clock of the host from the Date of its response
+
+    The Date is sent before the response is received, the offset errs on the side of an early server clock.
+    """
+    try:
+        server_time = parsedate_to_datetime(r.headers['Date']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return
+    with _lock:
+        _clock_offsets[_host(url)] = server_time - time.time()
+
+def clock_offset(url):
+    """
+    Seconds the clock of the host of `url` is ahead of the local clock, 0 until it answered a request
+    """
+    with _lock:
+        return _clock_offsets.get(_host(url), 0.0)
+
+def stats():
+    """
+    Connection reuse by host: requests sent and connections opened by the connection pools
+
+    :returns: dict of host to a tuple (requests, connections).
+    """
+    result = dict()
+    with _lock:
+        sessions = list(_sessions.items())
+    for (host, _), session in sessions:
+        adapter = session.get_adapter(f'{host}/')
+        num_requests, num_connections = result.get(host, (0, 0))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+        result[host] = (num_requests, num_connections)
+    return result
+
+def log_stats():
+    log = get_configured_logger(LOG_NAME)
+    for host, (num_requests, num_connections) in stats().items():
+        log.info('%s: %s requests over %s connections (%s reused)', host, num_requests, num_connections, max(0, num_requests - num_connections))
@@ -0,0 +1,313 @@
+'''
+Compile the where clause of a feature type into SDMX data query filters.
+
+Equality and IN predicates on dimensions become the series key of the query
+(`geo IN ('AT', 'BE')` -> `..AT+BE.`), range predicates on TIME_PERIOD become
+startPeriod and endPeriod. Only the predicates that cannot be expressed that
+way are evaluated on the rows that the server returns. The server matches periods
+of any frequency (startPeriod=2020 returns 2020-01 to 2020-12), so TIME_PERIOD
+predicates are evaluated on the rows too, unless the clause restricts the data
+to a single frequency that the period is written in.
+
+Supported syntax: comparisons (=, <>, !=, <, <=, >, >=), [NOT] IN (...),
+BETWEEN ... AND ..., AND, OR, NOT and parentheses. Identifiers may be double
+quoted, values are single quoted strings or numbers.
+'''
+from dataclasses import dataclass, field
+import re
+
+TIME_PERIOD = 'TIME_PERIOD'
+TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+        (?P<string>'(?:[^']|'')*')
+      | (?P<quoted>"(?:[^"]|"")*")
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<operator><>|!=|<=|>=|=|<|>)
+      | (?P<punctuation>[(),])
+      | (?P<word>[A-Za-z_][\w.]*)
+    )''', re.VERBOSE)
+KEYWORDS = {'AND', 'OR', 'NOT', 'IN', 'BETWEEN'}
+FREQUENCY = 'FREQ'
+# TIME_PERIOD format by frequency code
+PERIOD_FORMATS = {
+      'A': re.compile(r'\d{4}')
+    , 'S': re.compile(r'\d{4}-S\d')
+    , 'Q': re.compile(r'\d{4}-Q\d')
+    , 'M': re.compile(r'\d{4}-\d{2}')
+    , 'W': re.compile(r'\d{4}-W\d{2}')
+    , 'D': re.compile(r'\d{4}-\d{2}-\d{2}')
+}
+
+@dataclass
+class Compare:
+    column: str
+    operator: str
+    value: str
+
+@dataclass
+class In:
+    column: str
+    values: list
+    negated: bool = False
+
+@dataclass
+class And:
+    items: list
+
+@dataclass
+class Or:
+    items: list
+
+@dataclass
+class Not:
+    item: object
+
+@dataclass
+class Pushdown:
+    key_filter: dict = field(default_factory=dict)      # values by dimension id
+    start_period: str = None
+    end_period: str = None
+    residual: object = None     # predicate the server cannot apply, None if it applies the whole clause
+
+    @property
+    def empty(self):
+        """
+        The clause restricts a dimension to contradicting values and cannot match any observation
+        """
+        return any(not values for values in self.key_filter.values())
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        m = TOKEN_PATTERN.match(text, position)
+        if not m:
+            raise Exception(f'Unsupported where clause, unexpected `{text[position:].strip()}`')
+        position = m.end()
+        kind = m.lastgroup
+        value = m.group(kind)
+        if 'string' == kind:
+            value = value[1:-1].replace("''", "'")
+        elif 'quoted' == kind:
+            kind, value = 'word', value[1:-1].replace('""', '"')
+        elif 'word' == kind and value.upper() in KEYWORDS:
+            kind, value = 'keyword', value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+class _Parser:
+    def __init__(self, text):
+        self._text = text
+        self._tokens = _tokenize(text)
+        self._position = 0
+
+    def _peek(self, *values):
+        if self._position < len(self._tokens):
+            kind, value = self._tokens[self._position]
+            if not values or value in values and kind in ('keyword', 'operator', 'punctuation'):
+                return value
+        return None
+
+    def _next(self, *kinds):
+        if self._position >= len(self._tokens):
+            raise Exception(f'Unsupported where clause, unexpected end: {self._text}')
+        kind, value = self._tokens[self._position]
+        if kinds and kind not in kinds:
+            raise Exception(f'Unsupported where clause, unexpected `{value}`: {self._text}')
+        self._position += 1
+        return value
+
+    def _expect(self, value):
+        if self._peek(value) is None:
+            raise Exception(f'Unsupported where clause, `{value}` expected: {self._text}')
+        self._position += 1
+
+    def parse(self):
+        node = self._or()
+        if self._position < len(self._tokens):
+            raise Exception(f'Unsupported where clause, unexpected `{self._tokens[self._position][1]}`: {self._text}')
+        return node
+
+    def _or(self):
+        items = [self._and()]
+        while self._peek('OR'):
+            self._position += 1
+            items.append(self._and())
+        return items[0] if 1 == len(items) else Or(items)
+
+    def _and(self):
+        items = [self._not()]
+        while self._peek('AND'):
+            self._position += 1
+            items.append(self._not())
+        return items[0] if 1 == len(items) else And(items)
+
+    def _not(self):
+        if self._peek('NOT'):
+            self._position += 1
+            return Not(self._not())
+        if self._peek('('):
+            self._position += 1
+            node = self._or()
+            self._expect(')')
+            return node
+        return self._predicate()
+
+    def _value(self):
+        return self._next('string', 'number')
+
+    def _predicate(self):
+        column = self._next('word')
+        negated = bool(self._peek('NOT'))
+        if negated:
+            self._position += 1
+        if self._peek('IN'):
+            self._position += 1
+            self._expect('(')
+            values = [self._value()]
+            while self._peek(','):
+                self._position += 1
+                values.append(self._value())
+            self._expect(')')
+            return In(column, values, negated)
+        if self._peek('BETWEEN'):
+            self._position += 1
+            low = self._value()
+            self._expect('AND')
+            node = And([Compare(column, '>=', low), Compare(column, '<=', self._value())])
+            return Not(node) if negated else node
+        if negated:
+            raise Exception(f'Unsupported where clause, IN or BETWEEN expected after NOT: {self._text}')
+        operator = self._next('operator')
+        return Compare(column, '<>' if '!=' == operator else operator, self._value())
+
+def parse(text):
+    """
+    Parse a where clause into a tree of Compare, In, And, Or and Not nodes, None for an empty clause
+    """
+    if not text or not text.strip():
+        return None
+    return _Parser(text).parse()
+
+def _conjuncts(node):
+    if isinstance(node, And):
+        return [conjunct for item in node.items for conjunct in _conjuncts(item)]
+    return [node]
+
+def _dimension_values(node, find_dimension):
+    """
+    Dimension and values of a predicate that restricts a single dimension to a set of codes, (None, None) otherwise
+    """
+    if isinstance(node, Compare) and '=' == node.operator:
+        dimension = find_dimension(node.column)
+        return (dimension, [node.value]) if dimension else (None, None)
+    if isinstance(node, In) and not node.negated:
+        dimension = find_dimension(node.column)
+        return (dimension, list(node.values)) if dimension else (None, None)
+    if isinstance(node, Or):
+        # geo = 'AT' OR geo = 'BE'
+        dimension, values = None, []
+        for item in node.items:
+            item_dimension, item_values = _dimension_values(item, find_dimension)
+            if item_dimension is None or dimension not in (None, item_dimension):
+                return None, None
+            dimension = item_dimension
+            values += item_values
+        return dimension, values
+    return None, None
+
+def compile_where(text, find_dimension, periods=True):
+    """
+    Split a where clause into the filters of the data query and the residual predicate on its rows
+
+    :param find_dimension: Returns the id of the series key dimension a column name
+        refers to, or None if it is not a dimension.
+    :param bool periods: Translate TIME_PERIOD predicates into the query period. Not with
+        first or last N observations, these are the first or last of the whole series.
+    :rtype: Pushdown
+    """
+    node = parse(text)
+    pushdown = Pushdown()
+    if node is None:
+        return pushdown
+    residual = []
+    period_conjuncts = []
+    for conjunct in _conjuncts(node):
+        dimension, values = _dimension_values(conjunct, find_dimension)
+        if dimension:
+            if dimension in pushdown.key_filter:
+                # Both predicates must hold
+                values = [value for value in pushdown.key_filter[dimension] if value in values]
+            pushdown.key_filter[dimension] = list(dict.fromkeys(values))
+            continue
+        if periods and isinstance(conjunct, Compare) and TIME_PERIOD == conjunct.column.upper():
+            # The query periods are inclusive, a strict bound is always checked again on the rows
+            if conjunct.operator in ('>=', '>', '='):
+                pushdown.start_period = max(pushdown.start_period or conjunct.value, conjunct.value)
+            if conjunct.operator in ('<=', '<', '='):
+                pushdown.end_period = min(pushdown.end_period or conjunct.value, conjunct.value)
+            if conjunct.operator in ('>=', '<=', '='):
+                period_conjuncts.append(conjunct)
+                continue
+        residual.append(conjunct)
+    frequencies = pushdown.key_filter.get(find_dimension(FREQUENCY))
+    period_format = PERIOD_FORMATS.get(frequencies[0]) if frequencies and 1 == len(frequencies) else None
+    for conjunct in period_conjuncts:
+        # The server bound is exact only for periods of the frequency of the data
+        if period_format is None or not period_format.fullmatch(conjunct.value):
+            residual.append(conjunct)
+    if residual:
+        pushdown.residual = residual[0] if 1 == len(residual) else And(residual)
+    return pushdown
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _compare(left, operator, right):
+    # Numbers compare as numbers, everything else as strings, e.g. time periods `2010-Q1` < `2010-Q2`
+    left_number, right_number = _number(left), _number(right)
+    if left_number is not None and right_number is not None:
+        left, right = left_number, right_number
+    if '=' == operator:
+        return left == right
+    if '<>' == operator:
+        return left != right
+    if '<' == operator:
+        return left < right
+    if '<=' == operator:
+        return left <= right
+    if '>' == operator:
+        return left > right
+    return left >= right
+
+def make_filter(node, header):
+    """
+    Turn a predicate into a function of a row with the columns of `header`
+
+    Column names are matched exactly, otherwise ignoring case.
+    """
+    def index(column):
+        if column in header:
+            return header.index(column)
+        for i, name in enumerate(header):
+            if name.upper() == column.upper():
+                return i
+        raise Exception(f'Where clause column {column} not found in {header}')
+    if isinstance(node, Compare):
+        i, operator, value = index(node.column), node.operator, node.value
+        return lambda row: _compare(row[i], operator, value)
+    if isinstance(node, In):
+        i, values, negated = index(node.column), set(node.values), node.negated
+        return lambda row: (row[i] in values) != negated
+    if isinstance(node, And):
+        predicates = [make_filter(item, header) for item in node.items]
+        return lambda row: all(predicate(row) for predicate in predicates)
+    if isinstance(node, Or):
+        predicates = [make_filter(item, header) for item in node.items]
+        return lambda row: any(predicate(row) for predicate in predicates)
+    predicate = make_filter(node.item, header)
+    return lambda row: not predicate(row)
@@ -0,0 +1,174 @@
+'''
+Asynchronous extraction jobs against a local mock of the Eurostat dissemination API.
+
+The mock answers data queries with a queued job envelope and reports the statuses
+configured for each job key one after the other, repeating the last one.
+'''
+from contextlib import contextmanager
+import gzip
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+try:
+    from fmepy_eurostat import asyncjobs, download
+except ImportError as e:
+    # fmegeneral and requests are provided by FME
+    raise unittest.SkipTest(f'FME Python environment not available: {e}')
+
+CSV = 'DATAFLOW,LAST UPDATE,freq,geo,TIME_PERIOD,OBS_VALUE,OBS_FLAG\nESTAT:X(1.0),01/01/24 23:00:00,A,AT,2020,1.5,\n'
+
+def queued_envelope(key):
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+  <env:Header/>
+  <env:Body>
+    <ns0:syncResponse xmlns:ns0="http://estat.ec.europa.eu/disschain/soap/extraction">
+      <queued><id>{key}</id><status>SUBMITTED</status></queued>
+    </ns0:syncResponse>
+  </env:Body>
+</env:Envelope>'''
+
+def status_envelope(key, status):
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+  <env:Header/>
+  <env:Body>
+    <ns0:asyncResponse xmlns:ns0="http://estat.ec.europa.eu/disschain/soap/asynchronous">
+      <status><key>{key}</key><status>{status}</status></status>
+    </ns0:asyncResponse>
+  </env:Body>
+</env:Envelope>'''
+
+class MockServer(http.server.ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.statuses = dict()      # statuses still to report by job key
+        self.queued_key = None      # key of the job data queries are queued as
+        self.requests = []
+
+    @property
+    def base_uri(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def status_requests(self, key):
+        return [path for path in self.requests if path == f'/1.0/async/status/{key}']
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        server.requests.append(path)
+        if path.startswith('/sdmx/2.1/data/'):
+            self._send(queued_envelope(server.queued_key).encode(), 'text/xml')
+        elif path.startswith('/1.0/async/status/'):
+            key = path.rsplit('/', 1)[1]
+            statuses = server.statuses.get(key) or [asyncjobs.STATUS_UNKNOWN_REQUEST]
+            status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+            self._send(status_envelope(key, status).encode(), 'text/xml')
+        elif path.startswith('/1.0/async/data/'):
+            self._send(gzip.compress(CSV.encode()), 'application/vnd.sdmx.data+csv'
+                , {'Content-Disposition': 'attachment; filename="X.csv.gz"'})
+        else:
+            self.send_error(404)
+
+@contextmanager
+def mock_server():
+    server = MockServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def fast_manager(timeout=10):
+    return asyncjobs.AsyncJobManager(poll_interval=0.01, max_poll_interval=0.05, timeout=timeout)
+
+class ParseTest(unittest.TestCase):
+    def test_parse_queued(self):
+        self.assertEqual('job-1', asyncjobs.parse_queued(queued_envelope('job-1')))
+
+    def test_parse_queued_other_response(self):
+        self.assertIsNone(asyncjobs.parse_queued('DATAFLOW,LAST UPDATE,freq'))
+        self.assertIsNone(asyncjobs.parse_queued('<error>queued for nothing'))
+
+    def test_parse_status(self):
+        for status in (asyncjobs.STATUS_SUBMITTED, asyncjobs.STATUS_PROCESSING, asyncjobs.STATUS_AVAILABLE):
+            self.assertEqual(status, asyncjobs.parse_status(status_envelope('job-1', status)))
+        self.assertIsNone(asyncjobs.parse_status('not xml'))
+
+    def test_async_base_uri(self):
+        self.assertEqual('https://host/api', asyncjobs.async_base_uri('https://host/api/sdmx/2.1/data/X/A..'))
+        with self.assertRaises(Exception):
+            asyncjobs.async_base_uri('https://host/api/other')
+
+class AsyncJobManagerTest(unittest.TestCase):
+    def test_available_after_submitted_and_processing(self):
+        with mock_server() as server:
+            server.statuses['job-1'] = [asyncjobs.STATUS_SUBMITTED, asyncjobs.STATUS_PROCESSING, asyncjobs.STATUS_AVAILABLE]
+            url = fast_manager().wait(server.base_uri, 'job-1')
+            self.assertEqual(f'{server.base_uri}/1.0/async/data/job-1', url)
+            self.assertEqual(3, len(server.status_requests('job-1')))
+
+    def test_concurrent_jobs(self):
+        with mock_server() as server:
+            server.statuses['job-1'] = [asyncjobs.STATUS_PROCESSING] * 4 + [asyncjobs.STATUS_AVAILABLE]
+            server.statuses['job-2'] = [asyncjobs.STATUS_AVAILABLE]
+            manager = fast_manager()
+            futures = [manager.submit(server.base_uri, key) for key in ('job-1', 'job-2')]
+            self.assertEqual(
+                  [f'{server.base_uri}/1.0/async/data/{key}' for key in ('job-1', 'job-2')]
+                , [future.result(timeout=10) for future in futures]
+            )
+
+    def test_expired(self):
+        with mock_server() as server:
+            server.statuses['job-1'] = [asyncjobs.STATUS_PROCESSING, asyncjobs.STATUS_EXPIRED]
+            with self.assertRaisesRegex(Exception, 'job-1 is EXPIRED'):
+                fast_manager().wait(server.base_uri, 'job-1')
+
+    def test_unknown_request(self):
+        with mock_server() as server:
+            with self.assertRaisesRegex(Exception, 'UNKNOWN_REQUEST'):
+                fast_manager().wait(server.base_uri, 'job-1')
+
+    def test_timeout(self):
+        with mock_server() as server:
+            server.statuses['job-1'] = [asyncjobs.STATUS_PROCESSING]
+            with self.assertRaisesRegex(Exception, 'not available after'):
+                fast_manager(timeout=0.2).wait(server.base_uri, 'job-1')
+            self.assertGreater(len(server.status_requests('job-1')), 1)
+
+class FetchQueuedTest(unittest.TestCase):
+    def test_fetch_csv_waits_for_queued_job(self):
+        with mock_server() as server, tempfile.TemporaryDirectory() as folder, \
+                mock.patch.object(asyncjobs, 'JOBS', fast_manager()):
+            server.queued_key = 'job-1'
+            server.statuses['job-1'] = [asyncjobs.STATUS_SUBMITTED, asyncjobs.STATUS_AVAILABLE]
+            dst_filepath = os.path.join(folder, 'X.csv')
+            download.fetch_csv(f'{server.base_uri}/sdmx/2.1/data/X', {'format': 'SDMX-CSV'}, dst_filepath)
+            with open(dst_filepath, encoding='utf-8') as f:
+                self.assertEqual(CSV, f.read())
+            self.assertIn('/1.0/async/data/job-1', server.requests)
+
+if __name__ == '__main__':
+    unittest.main()